@@ -0,0 +1,212 @@
+# Measures how many elements per second the XML parsers get through, next to
+# the parsing loop pyosm started with as a baseline.
+#
+# Usage: python benchmark_parsing.py [file|osm|osc|changesets] [repeats] [backend ...]
+#
+# Files may be .osm, .osc or either gzipped. .osc files are read with
+# iter_osm_change_file, changeset dumps (files whose name contains
+# "changeset") with iter_changeset_file and anything else with iter_osm_file.
+# Instead of a file, one of the words osm, osc or changesets benchmarks a
+# sample of that kind generated from a fixed seed, so the numbers can be
+# reproduced anywhere; with no arguments the osm sample is used.
+#
+# The input is read into memory first so disk speed doesn't count, and the
+# best of the repeats is reported. Every XML parser backend available is
+# timed unless some are named. The baseline needs lxml.
+from pyosm.parsing import iter_osm_file, iter_osm_change_file, iter_changeset_file, XML_BACKENDS, etree
+import pyosm.model as model
+import datetime
+import gzip
+import io
+import random
+import sys
+import time
+
+SAMPLE_ELEMENTS = 100000
+SAMPLE_SEED = 1
+
+TAGS = [
+    ('highway', ['residential', 'service', 'footway', 'primary', 'track']),
+    ('building', ['yes', 'house', 'garage']),
+    ('name', None),
+    ('surface', ['asphalt', 'gravel', 'paved']),
+    ('source', ['survey', 'bing', 'local knowledge']),
+    ('addr:housenumber', None),
+]
+
+
+def _attrs(rnd, i):
+    return 'id="%d" version="%d" changeset="%d" user="user%d" uid="%d" visible="true" timestamp="2020-%02d-%02dT%02d:%02d:%02dZ"' % (
+        i, rnd.randint(1, 9), rnd.randint(1, 100000000), i % 500, i % 500,
+        rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+
+
+def _tags(rnd, count):
+    out = []
+    for k, values in rnd.sample(TAGS, count):
+        v = rnd.choice(values) if values else 'value %d' % rnd.randint(1, 100000)
+        out.append('<tag k="%s" v="%s"/>' % (k, v))
+    return ''.join(out)
+
+
+def _primitive(rnd, i):
+    r = rnd.random()
+    if r < 0.7:
+        coords = ' lat="%.7f" lon="%.7f"' % (rnd.uniform(-90, 90), rnd.uniform(-180, 180))
+        count = rnd.choice((0, 0, 0, 1, 2))
+        if not count:
+            return '<node %s%s/>' % (_attrs(rnd, i), coords)
+        return '<node %s%s>%s</node>' % (_attrs(rnd, i), coords, _tags(rnd, count))
+    elif r < 0.95:
+        nds = ''.join('<nd ref="%d"/>' % rnd.randint(1, i) for _ in range(rnd.randint(2, 12)))
+        return '<way %s>%s%s</way>' % (_attrs(rnd, i), nds, _tags(rnd, rnd.randint(1, 3)))
+    else:
+        members = ''.join('<member type="%s" ref="%d" role="%s"/>' % (rnd.choice(('node', 'way')), rnd.randint(1, i), rnd.choice(('', 'outer', 'inner')))
+                          for _ in range(rnd.randint(1, 8)))
+        return '<relation %s>%s<tag k="type" v="multipolygon"/>%s</relation>' % (_attrs(rnd, i), members, _tags(rnd, 1))
+
+
+def _changeset(rnd, i):
+    lat = rnd.uniform(-89, 89)
+    lon = rnd.uniform(-179, 179)
+    return ('<changeset id="%d" created_at="2020-01-01T00:00:%02dZ" closed_at="2020-01-01T01:00:%02dZ" open="false" '
+            'min_lat="%.7f" max_lat="%.7f" min_lon="%.7f" max_lon="%.7f" user="user%d" uid="%d">'
+            '<tag k="comment" v="edit %d"/><tag k="created_by" v="JOSM/1.5"/></changeset>') % (
+        i, i % 60, i % 60, lat, lat + 0.01, lon, lon + 0.01, i % 500, i % 500, i)
+
+
+def generate(kind, count=SAMPLE_ELEMENTS, seed=SAMPLE_SEED):
+    """Return a reproducible sample document of count elements: an OSM file
+    for 'osm', an osmChange for 'osc' or a changeset dump for 'changesets'."""
+    rnd = random.Random(seed)
+    if kind == 'changesets':
+        body = ''.join(_changeset(rnd, i) for i in range(1, count + 1))
+        return ('<osm version="0.6">%s</osm>' % body).encode('utf-8')
+
+    primitives = [_primitive(rnd, i) for i in range(1, count + 1)]
+    if kind == 'osc':
+        blocks = []
+        for start in range(0, count, 1000):
+            action = rnd.choice(('create', 'modify', 'delete'))
+            blocks.append('<%s>%s</%s>' % (action, ''.join(primitives[start:start + 1000]), action))
+        return ('<osmChange version="0.6">%s</osmChange>' % ''.join(blocks)).encode('utf-8')
+    return ('<osm version="0.6">%s</osm>' % ''.join(primitives)).encode('utf-8')
+
+
+def _maybe(convert, s):
+    return convert(s) if s is not None else s
+
+
+def _timestamp(s, parse_timestamps):
+    if parse_timestamps and s is not None:
+        return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ")
+    return s
+
+
+def baseline(f, parse_timestamps=True, change=False):
+    """The parsing loop pyosm started with: lxml's iterparse over start and
+    end events, building each object as its start tag arrives. Yields what
+    iter_osm_file does, or what iter_osm_change_file does if change is True."""
+    action = None
+    obj = None
+    for event, elem in etree.iterparse(f, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            a = elem.attrib
+            if tag in ('node', 'way', 'relation'):
+                common = (
+                    int(a['id']),
+                    _maybe(int, a.get('version')),
+                    _maybe(int, a.get('changeset')),
+                    a.get('user'),
+                    _maybe(int, a.get('uid')),
+                    _maybe(lambda v: v == 'true', a.get('visible')),
+                    _timestamp(a.get('timestamp'), parse_timestamps),
+                )
+                if tag == 'node':
+                    obj = model.Node(*common + (_maybe(float, a.get('lat')), _maybe(float, a.get('lon')), []))
+                elif tag == 'way':
+                    obj = model.Way(*common + ([], []))
+                else:
+                    obj = model.Relation(*common + ([], []))
+            elif tag == 'tag':
+                obj.tags.append(model.Tag(a['k'], a['v']))
+            elif tag == 'nd':
+                obj.nds.append(int(a['ref']))
+            elif tag == 'member':
+                obj.members.append(model.Member(a['type'], int(a['ref']), a['role']))
+            elif tag == 'changeset':
+                obj = model.Changeset(
+                    int(a['id']),
+                    _timestamp(a.get('created_at'), parse_timestamps),
+                    _timestamp(a.get('closed_at'), parse_timestamps),
+                    a['open'] == 'true',
+                    _maybe(float, a.get('min_lat')),
+                    _maybe(float, a.get('max_lat')),
+                    _maybe(float, a.get('min_lon')),
+                    _maybe(float, a.get('max_lon')),
+                    a.get('user'),
+                    _maybe(int, a.get('uid')),
+                    []
+                )
+            elif tag in ('create', 'modify', 'delete'):
+                action = tag
+        elif event == 'end':
+            if tag in ('node', 'way', 'relation', 'changeset'):
+                yield (action, obj) if change else obj
+                obj = None
+            elif tag in ('create', 'modify', 'delete'):
+                action = None
+
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def best_of(repeats, parse):
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        count = 0
+        for thing in parse():
+            count += 1
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count, best
+
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else 'osm'
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    backends = sys.argv[3:] or [b for b in XML_BACKENDS if etree is not None or b == 'expat']
+
+    if source in ('osm', 'osc', 'changesets'):
+        data = generate(source)
+        name = '%s sample (%d elements, seed %d)' % (source, SAMPLE_ELEMENTS, SAMPLE_SEED)
+        source = source + '.changeset' if source == 'changesets' else '.' + source
+    else:
+        opener = gzip.open if source.endswith('.gz') else open
+        with opener(source, 'rb') as f:
+            data = f.read()
+        name = source
+
+    change = '.osc' in source
+    if change:
+        parser = iter_osm_change_file
+    elif 'changeset' in source:
+        parser = iter_changeset_file
+    else:
+        parser = iter_osm_file
+
+    print('%s, %d bytes, best of %d' % (name, len(data), repeats))
+    for parse_timestamps in (True, False):
+        runs = []
+        if etree is not None:
+            runs.append(('baseline', lambda: baseline(io.BytesIO(data), parse_timestamps, change)))
+        for backend in backends:
+            runs.append(('%s backend=%s' % (parser.__name__, backend), lambda backend=backend: parser(io.BytesIO(data), parse_timestamps, backend=backend)))
+
+        for label, parse in runs:
+            count, best = best_of(repeats, parse)
+            print('%s parse_timestamps=%s: %d elements in %.2fs, %.0f elements/s' % (
+                label, parse_timestamps, count, best, count / best))
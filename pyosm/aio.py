@@ -0,0 +1,244 @@
+"""Asyncio versions of the replication and notes streams.
+
+They follow the same feeds and yield the same things as their counterparts
+in pyosm.parsing, but do their HTTP with aiohttp and wait with asyncio.sleep,
+so one event loop can follow many feeds at once. Decompressing and parsing a
+diff is CPU bound, so it is done in an executor (the loop's default thread
+pool unless one is given; pass a ProcessPoolExecutor to parse on other
+cores) and the parsed objects are then yielded from the loop.
+
+Needs Python 3.6+ and aiohttp."""
+
+import asyncio
+import os.path
+import time
+
+import aiohttp
+
+import pyosm.model as model
+from pyosm.parsing import (
+    NOTES_API_URL,
+    isoToDatetime,
+    isoToEpoch,
+    iter_changeset_file,
+    iter_osm_change_file,
+    parseNote,
+    parseNotesFeed,
+    readState,
+    sequenceUrl,
+)
+from pyosm.scheduler import PollScheduler
+from pyosm.transport import USER_AGENT, GzipStream, iter_chunks
+
+
+def _new_session(session):
+    """Return (session, whether we created it and so must close it)."""
+    if session is not None:
+        return session, False
+    return aiohttp.ClientSession(headers={'User-Agent': USER_AGENT}), True
+
+
+async def _get(session, url, **kwargs):
+    """Return the body of url, or None if it is a 404."""
+    async with session.get(url, **kwargs) as response:
+        if response.status == 404:
+            return None
+        response.raise_for_status()
+        return await response.read()
+
+
+async def _get_replication_file(session, cache, base_url, sequence, suffix):
+    # DiffCache reads, checks and writes whole files and walks its directory
+    # to evict, so it runs in the default thread pool to keep the loop free
+    # for other feeds.
+    loop = asyncio.get_event_loop()
+    if cache is not None:
+        data = await loop.run_in_executor(None, cache.get, base_url, sequence, suffix)
+        if data is not None:
+            return data
+
+    data = await _get(session, sequenceUrl(base_url, sequence, suffix))
+    if data is not None and cache is not None:
+        await loop.run_in_executor(None, cache.put, base_url, sequence, suffix, data)
+    return data
+
+
+def _parse_osm_change(content, parse_timestamps):
+    return list(iter_osm_change_file(GzipStream(iter_chunks(content)), parse_timestamps))
+
+
+def _parse_changesets(content, parse_timestamps):
+    return list(iter_changeset_file(GzipStream(iter_chunks(content)), parse_timestamps))
+
+
+async def aiter_osm_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/minute', expected_interval=60, parse_timestamps=True, state_dir=None, session=None, executor=None, cache=None):
+    """Async version of pyosm.parsing.iter_osm_stream. Yields (action,
+    primitive) tuples, then (None, Finished) after each diff.
+
+    session is an aiohttp.ClientSession to share between feeds; one is
+    created (and closed when the generator is) if it isn't given."""
+
+    loop = asyncio.get_event_loop()
+    session, own_session = _new_session(session)
+
+    try:
+        # If the user specifies a state_dir, read the state from the statefile there
+        if state_dir:
+            if not os.path.exists(state_dir):
+                raise Exception('Specified state_dir "%s" doesn\'t exist.' % state_dir)
+
+            if os.path.exists('%s/state.txt' % state_dir):
+                with open('%s/state.txt' % state_dir) as f:
+                    state = readState(f.read())
+                    start_sqn = state['sequenceNumber']
+
+        # If no start_sqn, assume to start from the most recent diff
+        if not start_sqn:
+            state_text = await _get(session, '%s/state.txt' % base_url)
+        else:
+            state_text = await _get_replication_file(session, cache, base_url, int(start_sqn), 'state.txt')
+        if state_text is None:
+            raise Exception('State file for sequence %s doesn\'t exist.' % start_sqn)
+        state = readState(state_text.decode('utf-8'))
+
+        scheduler = PollScheduler(expected_interval)
+        while True:
+            sequence = int(state['sequenceNumber'])
+            stateTs = isoToDatetime(state['timestamp'])
+            stateEpoch = isoToEpoch(state['timestamp'])
+            scheduler.observe_state(stateEpoch)
+
+            content = await _get_replication_file(session, cache, base_url, sequence, 'osc.gz')
+            if content is None:
+                raise Exception('Diff for sequence %d is missing although its state file exists.' % sequence)
+
+            changes = await loop.run_in_executor(executor, _parse_osm_change, content, parse_timestamps)
+            del content
+            for a in changes:
+                yield a
+            del changes
+
+            yield (None, model.Finished(state['sequenceNumber'], stateTs))
+
+            await asyncio.sleep(scheduler.seconds_until_poll(stateEpoch))
+
+            # Then try to fetch the next state file
+            retries = 0
+            while True:
+                state_text = await _get_replication_file(session, cache, base_url, sequence + 1, 'state.txt')
+                if state_text is not None:
+                    break
+
+                scheduler.missed()
+                retries += 1
+                await asyncio.sleep(scheduler.retry_delay(retries))
+
+            state_text = state_text.decode('utf-8')
+            scheduler.found(isoToEpoch(readState(state_text)['timestamp']))
+
+            if state_dir:
+                with open('%s/state.txt' % state_dir, 'w') as f:
+                    f.write(state_text)
+            state = readState(state_text)
+    finally:
+        if own_session:
+            await session.close()
+
+
+async def aiter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/changesets', expected_interval=60, parse_timestamps=True, state_dir=None, session=None, executor=None, cache=None):
+    """Async version of pyosm.parsing.iter_changeset_stream. Yields one
+    Changeset at a time, then a Finished after each changeset file."""
+
+    loop = asyncio.get_event_loop()
+    session, own_session = _new_session(session)
+
+    try:
+        # If the user specifies a state_dir, read the state from the statefile there
+        if state_dir:
+            if not os.path.exists(state_dir):
+                raise Exception('Specified state_dir "%s" doesn\'t exist.' % state_dir)
+
+            if os.path.exists('%s/state.yaml' % state_dir):
+                with open('%s/state.yaml' % state_dir, 'r') as f:
+                    state = readState(f.read(), ': ')
+                    start_sqn = state['sequence']
+
+        # If no start_sqn, assume to start from the most recent changeset file
+        if not start_sqn:
+            state_text = await _get(session, '%s/state.yaml' % base_url)
+            if state_text is None:
+                raise Exception('Changeset state file at %s doesn\'t exist.' % base_url)
+            sequenceNumber = int(readState(state_text.decode('utf-8'), ': ')['sequence'])
+        else:
+            sequenceNumber = int(start_sqn)
+
+        while True:
+            # There's no state file for each changeset file, so just poll
+            # for the next one until it stops being a 404.
+            delay = 1.0
+            while True:
+                content = await _get_replication_file(session, cache, base_url, sequenceNumber, 'osm.gz')
+                if content is not None:
+                    break
+
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 13)
+
+            changesets = await loop.run_in_executor(executor, _parse_changesets, content, parse_timestamps)
+            del content
+            for obj in changesets:
+                yield obj
+            del changesets
+
+            yield model.Finished(sequenceNumber, None)
+
+            sequenceNumber += 1
+
+            if state_dir:
+                with open('%s/state.yaml' % state_dir, 'w') as f:
+                    f.write('sequence: %d' % sequenceNumber)
+    finally:
+        if own_session:
+            await session.close()
+
+
+async def aget_note(note_id, parse_timestamps=True, session=None):
+    """Async version of pyosm.parsing.get_note."""
+    session, own_session = _new_session(session)
+    try:
+        async with session.get('%s/%d' % (NOTES_API_URL, note_id)) as response:
+            response.raise_for_status()
+            return parseNote(await response.read(), parse_timestamps)
+    finally:
+        if own_session:
+            await session.close()
+
+
+async def aiter_osm_notes(feed_limit=25, interval=60, parse_timestamps=True, session=None):
+    """Async version of pyosm.parsing.iter_osm_notes. The notes new in each
+    read of the feed are fetched concurrently."""
+
+    session, own_session = _new_session(session)
+
+    try:
+        last_seen_guid = None
+        while True:
+            started = time.time()
+            async with session.get('%s/feed' % NOTES_API_URL, params=dict(limit=feed_limit)) as response:
+                response.raise_for_status()
+                content = await response.read()
+
+            new_note_ids, last_seen_guid = parseNotesFeed(content, last_seen_guid)
+            notes = await asyncio.gather(*[aget_note(note_id, parse_timestamps, session) for _, note_id in new_note_ids])
+
+            # We yield the reversed list because we want to yield in change order
+            # (i.e. "oldest to most current")
+            for (action, _), note in reversed(list(zip(new_note_ids, notes))):
+                yield (action, note)
+
+            yield model.Finished(None, None)
+
+            await asyncio.sleep(max(0.0, interval - (time.time() - started)))
+    finally:
+        if own_session:
+            await session.close()
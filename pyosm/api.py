@@ -1,24 +1,89 @@
-import urllib2
+import io
+from multiprocessing.pool import ThreadPool
+from pyosm.parallel import imap_ordered
 from pyosm.parsing import iter_osm_file, iter_osm_change_file
+from pyosm.transport import get_transport, USER_AGENT
+
+# Longest comma-separated id list sent in one multi-fetch request. Keeps the
+# whole URL comfortably under the 8KB or so that servers and proxies accept.
+MAX_IDS_LENGTH = 6000
+
+_MISSING = object()
+
+
+def chunk_ids(thing_ids, max_length=MAX_IDS_LENGTH):
+    """Split an iterable of ids into lists whose comma-joined form is at most
+    max_length characters. Ids may also be strings such as "123v2"."""
+    chunk = []
+    length = 0
+    for thing_id in thing_ids:
+        thing_id = str(thing_id)
+        if chunk and length + 1 + len(thing_id) > max_length:
+            yield chunk
+            chunk = []
+            length = 0
+        length += len(thing_id) + (1 if chunk else 0)
+        chunk.append(thing_id)
+    if chunk:
+        yield chunk
 
 
 class Api(object):
-    def __init__(self, base_url='https://api.openstreetmap.org/api'):
+    """A client for the read-only parts of the OSM API.
+
+    Multi-fetches (get_nodes and friends) are split into requests of at most
+    max_ids_length characters of ids, and up to workers of them are made at
+    once over the transport's pooled connections.
+
+    If cache is a pyosm.cache.ObjectCache, lookups are answered from it when
+    possible and what's fetched is stored in it. Objects fetched by
+    multi-fetch are stored too, so later single lookups of them are hits."""
+
+    def __init__(self, base_url='https://api.openstreetmap.org/api', transport=None, workers=4, max_ids_length=MAX_IDS_LENGTH, cache=None):
         self._base = base_url
-        self.USER_AGENT = 'pyosm/1.0 (http://github.com/iandees/pyosm)'
+        self._transport = get_transport(transport)
+        self._cache = cache
+        self._workers = workers
+        self._max_ids_length = max_ids_length
+        self.USER_AGENT = USER_AGENT
 
     def _get(self, path, params={}):
         headers = {
             'User-Agent': self.USER_AGENT
         }
-        req = urllib2.Request(self._base + path, headers=headers)
+        response = self._transport.get(self._base + path, params=params, headers=headers)
+        response.raise_for_status()
 
-        return urllib2.urlopen(req)
+        return io.BytesIO(response.content)
 
     def _get_as_osm(self, path, params={}):
         return [t for t in iter_osm_file(self._get(path, params))]
 
+    def _cached(self, key, fetch):
+        if self._cache is None:
+            return fetch()
+
+        value = self._cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = fetch()
+            self._cache.put(key, value)
+        return value
+
+    def _remember(self, kind, thing, latest):
+        """Store a fetched object under its version and, if it was asked for
+        as the latest version, as the latest too."""
+        if self._cache is not None and thing is not None:
+            if latest:
+                self._cache.put((kind, thing.id, None), thing)
+            if thing.version is not None:
+                self._cache.put((kind, thing.id, thing.version), thing)
+
     def _get_object_revision_as_osm(self, kind, thing_id, version=None):
+        if self._cache is not None:
+            single = self._cache.get((kind, thing_id, version), _MISSING)
+            if single is not _MISSING:
+                return single
+
         path = '/0.6/{}/{}'.format(kind, thing_id)
         if version:
             path += '/' + str(version)
@@ -29,6 +94,10 @@ class Api(object):
         if everything:
             single = next(iter(everything))
 
+        if self._cache is not None:
+            self._cache.put((kind, thing_id, version), single)
+            self._remember(kind, single, version is None)
+
         return single
 
     def get_node(self, node_id, version=None):
@@ -40,13 +109,39 @@ class Api(object):
     def get_relation(self, relation_id, version=None):
         return self._get_object_revision_as_osm('relation', relation_id, version)
 
-    def _get_objects_as_osm(self, kind, thing_ids):
+    def _get_chunk_as_osm(self, args):
+        path, plural_kind, chunk = args
+        return chunk, self._get_as_osm(path, params={plural_kind: ','.join(chunk)})
+
+    def _remember_chunk(self, kind, chunk, everything):
+        # Ids asked for with a version ("123v2") aren't the latest version
+        latest_ids = set(thing_id for thing_id in chunk if 'v' not in thing_id)
+        for thing in everything:
+            self._remember(kind, thing, str(thing.id) in latest_ids)
+            yield thing
+
+    def _iter_objects_as_osm(self, kind, thing_ids):
         plural_kind = kind + 's'
         path = '/0.6/{}'.format(plural_kind)
 
-        everything = self._get_as_osm(path, params={plural_kind: thing_ids})
+        chunks = ((path, plural_kind, chunk) for chunk in chunk_ids(thing_ids, self._max_ids_length))
+
+        if self._workers and self._workers > 1:
+            pool = ThreadPool(self._workers)
+            try:
+                for chunk, everything in imap_ordered(pool, self._get_chunk_as_osm, chunks, self._workers):
+                    for thing in self._remember_chunk(kind, chunk, everything):
+                        yield thing
+            finally:
+                pool.terminate()
+        else:
+            for args in chunks:
+                chunk, everything = self._get_chunk_as_osm(args)
+                for thing in self._remember_chunk(kind, chunk, everything):
+                    yield thing
 
-        return everything
+    def _get_objects_as_osm(self, kind, thing_ids):
+        return list(self._iter_objects_as_osm(kind, thing_ids))
 
     def get_nodes(self, node_ids):
         return self._get_objects_as_osm('node', node_ids)
@@ -57,12 +152,31 @@ class Api(object):
     def get_relations(self, relation_ids):
         return self._get_objects_as_osm('relation', relation_ids)
 
+    def iter_nodes(self, node_ids):
+        """Like get_nodes, but yields nodes as each request's response is
+        parsed, in the order of node_ids' chunks."""
+        return self._iter_objects_as_osm('node', node_ids)
+
+    def iter_ways(self, way_ids):
+        return self._iter_objects_as_osm('way', way_ids)
+
+    def iter_relations(self, relation_ids):
+        return self._iter_objects_as_osm('relation', relation_ids)
+
     def _get_object_history_as_osm(self, kind, thing_id):
         path = '/0.6/{}/{}/history'.format(kind, thing_id)
 
-        everything = self._get_as_osm(path)
+        def fetch():
+            everything = self._get_as_osm(path)
+
+            # Every version in a history is immutable, so keep them all
+            if self._cache is not None:
+                for thing in everything:
+                    self._cache.put((kind, thing.id, thing.version), thing)
+
+            return everything
 
-        return everything
+        return self._cached((kind + '_history', thing_id, None), fetch)
 
     def get_node_history(self, node_id):
         return self._get_object_history_as_osm('node', node_id)
@@ -74,7 +188,13 @@ class Api(object):
         return self._get_object_history_as_osm('relation', relation_id)
 
     def get_changeset_download(self, changeset_id):
-        return [t for t in iter_osm_change_file(self._get('/0.6/changeset/{}/download'.format(changeset_id)))]
+        return self._cached(
+            ('changeset_download', changeset_id, None),
+            lambda: [t for t in iter_osm_change_file(self._get('/0.6/changeset/{}/download'.format(changeset_id)))]
+        )
 
     def get_changeset_metadata(self, changeset_id):
-        return next(iter(self._get_as_osm('/0.6/changeset/{}'.format(changeset_id))))
+        return self._cached(
+            ('changeset', changeset_id, None),
+            lambda: next(iter(self._get_as_osm('/0.6/changeset/{}'.format(changeset_id))))
+        )
@@ -0,0 +1,215 @@
+import collections
+import hashlib
+import os
+import shelve
+import tempfile
+import threading
+import time
+import zlib
+from pyosm.transport import CHUNK_SIZE, GzipStream
+
+
+def _gzip_complete(path):
+    """Check that a gzip file decompresses to the end of its last member,
+    trailer included."""
+    with open(path, 'rb') as f:
+        stream = GzipStream(iter(lambda: f.read(CHUNK_SIZE), b''))
+        try:
+            while stream.read(CHUNK_SIZE):
+                pass
+        except (EOFError, zlib.error):
+            return False
+    return True
+
+
+class DiffCache(object):
+    """An on-disk cache of replication files (state files and gzipped diffs),
+    so replays, backfills and several consumers on one host only download
+    each file once. Published replication files never change, so entries
+    don't expire; the least recently used ones are evicted once the cache
+    grows past max_bytes (if given).
+
+    Files are stored under directory/<hash of base_url>/<sequence path>, so
+    several feeds can share one cache directory."""
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, base_url, sequence, suffix):
+        feed = hashlib.sha1(base_url.encode('utf-8')).hexdigest()[:16]
+        sqnStr = str(sequence).zfill(9)
+        return os.path.join(self.directory, feed, sqnStr[0:3], sqnStr[3:6], '%s.%s' % (sqnStr[6:9], suffix))
+
+    def get(self, base_url, sequence, suffix):
+        """Return the cached bytes of a replication file, or None."""
+        path = self.path(base_url, sequence, suffix)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        # Bump the modification time so eviction is least-recently-used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return data
+
+    def _temp_file(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another consumer may have just created it
+                if not os.path.isdir(directory):
+                    raise
+        return tempfile.NamedTemporaryFile(dir=directory, prefix='.tmp', delete=False)
+
+    def _commit(self, temp, path, size):
+        temp.close()
+
+        # Never keep a cut-off download: every later read of it would fail
+        if path.endswith('.gz') and not _gzip_complete(temp.name):
+            os.unlink(temp.name)
+            return
+
+        os.rename(temp.name, path)
+
+        if self._size is not None:
+            self._size += size
+        self._evict()
+
+    def put(self, base_url, sequence, suffix, data):
+        path = self.path(base_url, sequence, suffix)
+        temp = self._temp_file(path)
+        try:
+            temp.write(data)
+        except Exception:
+            temp.close()
+            os.unlink(temp.name)
+            raise
+        self._commit(temp, path, len(data))
+
+    def tee(self, base_url, sequence, suffix, chunks):
+        """Pass chunks through while writing them to the cache. The entry is
+        only added if the chunks are read to the end and, for gzipped files,
+        hold a complete gzip stream."""
+        path = self.path(base_url, sequence, suffix)
+        temp = self._temp_file(path)
+        size = 0
+        try:
+            for chunk in chunks:
+                temp.write(chunk)
+                size += len(chunk)
+                yield chunk
+        except BaseException:
+            temp.close()
+            os.unlink(temp.name)
+            raise
+        self._commit(temp, path, size)
+
+    def _entries(self):
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+
+        # The running total is only an estimate when other processes share
+        # the directory, so rescan before deciding what to delete.
+        if self._size is not None and self._size <= self.max_bytes:
+            return
+
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+class ObjectCache(object):
+    """A memoizing cache for OSM API lookups, keyed by (kind, id, version).
+
+    A specific version of an object never changes, so entries with a version
+    don't expire. Lookups of the latest version (version None), histories and
+    the like can go stale, so they expire ttl seconds after being stored.
+    Either way at most max_entries are kept in memory, evicting the least
+    recently used.
+
+    If path is given, versioned entries are also written to a shelve file
+    there, so they survive between runs and outlive memory eviction."""
+
+    def __init__(self, max_entries=100000, ttl=60, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._shelf = shelve.open(path) if path else None
+
+    @staticmethod
+    def _shelf_key(key):
+        return '/'.join(str(k) for k in key)
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if there isn't a
+        fresh one."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] is not None and entry[0] < time.time():
+                entry = None
+
+            if entry is None and self._shelf is not None and key[2] is not None:
+                try:
+                    entry = (None, self._shelf[self._shelf_key(key)])
+                except KeyError:
+                    pass
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        immutable = key[2] is not None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (None if immutable else time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            if immutable and self._shelf is not None:
+                self._shelf[self._shelf_key(key)] = value
+
+    def close(self):
+        with self._lock:
+            self._entries.clear()
+            if self._shelf is not None:
+                self._shelf.close()
+                self._shelf = None
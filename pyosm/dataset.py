@@ -0,0 +1,95 @@
+import collections
+
+
+class OsmDataset(tuple):
+    """The nodes, ways and relations of an OSM file held in memory, as
+    returned by pyosm.parsing.parse_osm_file.
+
+    It is a (nodes, ways, relations) tuple of lists, so it can be unpacked
+    like one, and adds lookups by id, by referenced node or member, and by
+    tag. The index behind each kind of lookup is built the first time it's
+    used, so only the lookups a caller makes cost anything. The indexes
+    aren't updated if the lists are changed afterwards.
+
+    If an id appears more than once (as in history files), lookups by id
+    return the last one in the file."""
+
+    def __new__(cls, nodes, ways, relations):
+        return tuple.__new__(cls, (nodes, ways, relations))
+
+    def __init__(self, nodes, ways, relations):
+        self._ids = None
+        self._node_ways = None
+        self._member_relations = None
+        self._tag_keys = None
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    @property
+    def nodes(self):
+        return self[0]
+
+    @property
+    def ways(self):
+        return self[1]
+
+    @property
+    def relations(self):
+        return self[2]
+
+    def _id_index(self):
+        if self._ids is None:
+            self._ids = {
+                'node': dict((n.id, n) for n in self.nodes),
+                'way': dict((w.id, w) for w in self.ways),
+                'relation': dict((r.id, r) for r in self.relations),
+            }
+        return self._ids
+
+    def get(self, kind, element_id, default=None):
+        """Return the 'node', 'way' or 'relation' with element_id."""
+        return self._id_index()[kind].get(element_id, default)
+
+    def node(self, node_id):
+        return self.get('node', node_id)
+
+    def way(self, way_id):
+        return self.get('way', way_id)
+
+    def relation(self, relation_id):
+        return self.get('relation', relation_id)
+
+    def ways_with_node(self, node_id):
+        """Return the ways that use the node, in file order."""
+        if self._node_ways is None:
+            index = collections.defaultdict(list)
+            for way in self.ways:
+                for nd in set(way.nds):
+                    index[nd].append(way)
+            self._node_ways = index
+        return list(self._node_ways.get(node_id, ()))
+
+    def relations_with_member(self, kind, ref):
+        """Return the relations that have the 'node', 'way' or 'relation'
+        with id ref as a member, in file order."""
+        if self._member_relations is None:
+            index = collections.defaultdict(list)
+            for relation in self.relations:
+                for member in set((m.type, m.ref) for m in relation.members):
+                    index[member].append(relation)
+            self._member_relations = index
+        return list(self._member_relations.get((kind, ref), ()))
+
+    def with_tag(self, key, value=None):
+        """Return the nodes, ways and relations (in that order) that have a
+        tag with key and, if value is given, that value."""
+        if self._tag_keys is None:
+            index = collections.defaultdict(list)
+            for primitives in self:
+                for p in primitives:
+                    for tag in p.tags:
+                        index[tag.key].append((tag.value, p))
+            self._tag_keys = index
+
+        return [p for v, p in self._tag_keys.get(key, ()) if value is None or v == value]
@@ -1,3 +1,4 @@
+import array
 import collections
 
 # OSM Objects
@@ -14,3 +15,227 @@ Comment = collections.namedtuple('Comment', 'created_at, user, uid, action, text
 
 # pyosm Metadata
 Finished = collections.namedtuple('Finished', 'sequence, timestamp')
+
+# Columnar batches of OSM Objects. Each field is a NumPy array; tags, nds and
+# members are stored flat with an offsets array so that the values belonging
+# to the i-th element are values[offsets[i]:offsets[i + 1]].
+NodeBatch = collections.namedtuple('NodeBatch', 'id, version, changeset, uid, lat, lon, tag_offsets, tag_keys, tag_values')
+WayBatch = collections.namedtuple('WayBatch', 'id, version, changeset, uid, nd_offsets, nds, tag_offsets, tag_keys, tag_values')
+RelationBatch = collections.namedtuple('RelationBatch', 'id, version, changeset, uid, member_offsets, member_types, member_refs, member_roles, tag_offsets, tag_keys, tag_values')
+
+
+# Compact OSM Objects
+#
+# These have the same attribute names as Node, Way and Relation but use far
+# less memory when many of them are held at once: coordinates are stored as
+# fixed-point 1e-7 degrees packed into a single integer, nds as an array of
+# 64-bit ints, and tags and members as flat tuples of interned strings. The
+# tags and members attributes build lists of Tag and Member on access.
+
+try:
+    from sys import intern as _intern
+except ImportError:
+    _intern = intern  # noqa: F821 (Python 2)
+
+COORDINATE_PRECISION = 10000000
+
+# Typecode for arrays of OSM ids, which need 64 bits. Python 2's array has no
+# 'q', but its 'l' is 64 bits on every platform other than Windows.
+try:
+    array.array('q')
+    ID_TYPECODE = 'q'
+except ValueError:
+    ID_TYPECODE = 'l'
+
+
+def intern_string(s):
+    if s is None:
+        return s
+    try:
+        return _intern(s)
+    except TypeError:
+        # Python 2 can't intern unicode strings
+        return s
+
+
+class StringTable(object):
+    """A bounded intern table for the strings the parsers read. Tag keys,
+    member types and roles and user names come from a small vocabulary and
+    most tag values do too, so sharing one copy of each saves memory and
+    makes later hashing and comparing of them cheaper.
+
+    The table is emptied whenever it holds max_size strings, so memory stays
+    bounded while the common strings quickly come back. Values longer than
+    max_value_length (names, notes and the like) are rarely repeated and
+    aren't interned."""
+
+    def __init__(self, max_size=65536, max_value_length=24):
+        self.max_size = max_size
+        self.max_value_length = max_value_length
+        self.hits = 0
+        self.misses = 0
+        self.clears = 0
+        self._table = {}
+
+    def intern(self, s):
+        """Return the table's copy of s, adding s if it isn't there."""
+        shared = self._table.get(s)
+        if shared is not None:
+            self.hits += 1
+            return shared
+
+        if s is None:
+            return s
+
+        self.misses += 1
+        if len(self._table) >= self.max_size:
+            self._table.clear()
+            self.clears += 1
+        self._table[s] = s
+        return s
+
+    def intern_value(self, s):
+        """Like intern, but leaves long strings alone."""
+        if s is None or len(s) > self.max_value_length:
+            return s
+        return self.intern(s)
+
+    def stats(self):
+        return {
+            'size': len(self._table),
+            'hits': self.hits,
+            'misses': self.misses,
+            'clears': self.clears,
+        }
+
+
+# The table the parsers use unless they're given one
+default_string_table = StringTable()
+
+
+def _flatten_tags(tags):
+    flat = []
+    for t in tags:
+        flat.append(intern_string(t.key))
+        flat.append(t.value)
+    return tuple(flat)
+
+
+# A CompactNode's location is one int: the longitude in the high 32 bits and
+# the latitude in the low 32, both as unsigned 1e-7 degree offsets from
+# -180/-90. That's one object of at most 36 bytes instead of two 24 byte
+# floats. _NO_COORDINATE marks a half that's missing.
+_LON_OFFSET = 180 * COORDINATE_PRECISION
+_LAT_OFFSET = 90 * COORDINATE_PRECISION
+_NO_COORDINATE = 0xFFFFFFFF
+
+
+def _pack_location(lat, lon):
+    if lat is None and lon is None:
+        return None
+    packed_lon = int(round(lon * COORDINATE_PRECISION)) + _LON_OFFSET if lon is not None else _NO_COORDINATE
+    packed_lat = int(round(lat * COORDINATE_PRECISION)) + _LAT_OFFSET if lat is not None else _NO_COORDINATE
+    return (packed_lon << 32) | packed_lat
+
+
+def _unpack_coordinate(packed, offset):
+    if packed == _NO_COORDINATE:
+        return None
+    return (packed - offset) / float(COORDINATE_PRECISION)
+
+
+class _CompactPrimitive(object):
+    __slots__ = ('id', 'version', 'changeset', 'user', 'uid', 'visible', 'timestamp', '_tags')
+
+    def _set_common(self, p):
+        self.id = p.id
+        self.version = p.version
+        self.changeset = p.changeset
+        self.user = intern_string(p.user)
+        self.uid = p.uid
+        self.visible = p.visible
+        self.timestamp = p.timestamp
+        self._tags = _flatten_tags(p.tags)
+
+    @property
+    def tags(self):
+        t = self._tags
+        return [Tag(t[i], t[i + 1]) for i in range(0, len(t), 2)]
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.to_primitive() == other.to_primitive()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Compact' + repr(self.to_primitive())
+
+
+class CompactNode(_CompactPrimitive):
+    __slots__ = ('_location',)
+
+    def __init__(self, node):
+        self._set_common(node)
+        self._location = _pack_location(node.lat, node.lon)
+
+    @property
+    def lat(self):
+        if self._location is None:
+            return None
+        return _unpack_coordinate(self._location & 0xFFFFFFFF, _LAT_OFFSET)
+
+    @property
+    def lon(self):
+        if self._location is None:
+            return None
+        return _unpack_coordinate(self._location >> 32, _LON_OFFSET)
+
+    def to_primitive(self):
+        return Node(self.id, self.version, self.changeset, self.user, self.uid, self.visible, self.timestamp, self.lat, self.lon, self.tags)
+
+
+class CompactWay(_CompactPrimitive):
+    __slots__ = ('nds',)
+
+    def __init__(self, way):
+        self._set_common(way)
+        self.nds = array.array(ID_TYPECODE, way.nds)
+
+    def to_primitive(self):
+        return Way(self.id, self.version, self.changeset, self.user, self.uid, self.visible, self.timestamp, list(self.nds), self.tags)
+
+
+class CompactRelation(_CompactPrimitive):
+    __slots__ = ('_members',)
+
+    def __init__(self, relation):
+        self._set_common(relation)
+        flat = []
+        for m in relation.members:
+            flat.append(intern_string(m.type))
+            flat.append(m.ref)
+            flat.append(intern_string(m.role))
+        self._members = tuple(flat)
+
+    @property
+    def members(self):
+        m = self._members
+        return [Member(m[i], m[i + 1], m[i + 2]) for i in range(0, len(m), 3)]
+
+    def to_primitive(self):
+        return Relation(self.id, self.version, self.changeset, self.user, self.uid, self.visible, self.timestamp, self.members, self.tags)
+
+
+_compact_types = {
+    Node: CompactNode,
+    Way: CompactWay,
+    Relation: CompactRelation,
+}
+
+
+def compact(p):
+    """Return the compact form of a Node, Way or Relation. Anything else is
+    returned unchanged."""
+    compact_type = _compact_types.get(type(p))
+    return compact_type(p) if compact_type else p
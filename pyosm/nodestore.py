@@ -0,0 +1,186 @@
+import array
+import bisect
+import mmap
+import struct
+import tempfile
+from pyosm.model import COORDINATE_PRECISION, ID_TYPECODE
+
+# Node location stores map a node id to its (lon, lat). They all share the
+# small dict-like interface get_shapes needs: store[id] = (lon, lat),
+# store.get(id), id in store, del store[id] and close().
+#
+# The array-backed stores keep coordinates as fixed-point int32 in 1e-7
+# degrees, the precision OSM uses. Latitudes are stored shifted up by
+# LAT_SHIFT so that an all-zero slot can mean "no location".
+
+LAT_SHIFT = 90 * COORDINATE_PRECISION + 1
+
+
+def _encode(loc):
+    lon, lat = loc
+    return int(round(lon * COORDINATE_PRECISION)), int(round(lat * COORDINATE_PRECISION)) + LAT_SHIFT
+
+
+def _decode(lon, lat):
+    return (lon / float(COORDINATE_PRECISION), (lat - LAT_SHIFT) / float(COORDINATE_PRECISION))
+
+
+class DictNodeStore(object):
+    """Keeps locations in a Python dict. Fastest for small extracts, but costs
+    well over 100 bytes per node."""
+
+    def __init__(self):
+        self._locations = {}
+
+    def __setitem__(self, node_id, loc):
+        self._locations[node_id] = loc
+
+    def __delitem__(self, node_id):
+        del self._locations[node_id]
+
+    def __contains__(self, node_id):
+        return node_id in self._locations
+
+    def __len__(self):
+        return len(self._locations)
+
+    def get(self, node_id, default=None):
+        return self._locations.get(node_id, default)
+
+    def close(self):
+        self._locations = {}
+
+
+class SparseNodeStore(object):
+    """Keeps locations in sorted parallel arrays, 16 bytes per node, with
+    O(log n) lookups. Appending ids in increasing order (as in a sorted OSM
+    file) is cheap; out of order ids are sorted in on the next lookup."""
+
+    def __init__(self):
+        self._ids = array.array(ID_TYPECODE)
+        self._lons = array.array('i')
+        self._lats = array.array('i')
+        self._sorted = True
+
+    def __setitem__(self, node_id, loc):
+        if self._ids and node_id <= self._ids[-1]:
+            self._sorted = False
+        lon, lat = _encode(loc)
+        self._ids.append(node_id)
+        self._lons.append(lon)
+        self._lats.append(lat)
+
+    def _sort(self):
+        order = sorted(range(len(self._ids)), key=self._ids.__getitem__)
+
+        # Later writes to the same id win, so keep the last of each run
+        ids = array.array(ID_TYPECODE)
+        lons = array.array('i')
+        lats = array.array('i')
+        for i in order:
+            if ids and ids[-1] == self._ids[i]:
+                lons[-1] = self._lons[i]
+                lats[-1] = self._lats[i]
+            else:
+                ids.append(self._ids[i])
+                lons.append(self._lons[i])
+                lats.append(self._lats[i])
+
+        self._ids, self._lons, self._lats = ids, lons, lats
+        self._sorted = True
+
+    def _index(self, node_id):
+        if not self._sorted:
+            self._sort()
+        i = bisect.bisect_left(self._ids, node_id)
+        if i < len(self._ids) and self._ids[i] == node_id and self._lats[i]:
+            return i
+        return None
+
+    def __delitem__(self, node_id):
+        i = self._index(node_id)
+        if i is None:
+            raise KeyError(node_id)
+        self._lats[i] = 0
+
+    def __contains__(self, node_id):
+        return self._index(node_id) is not None
+
+    def __len__(self):
+        if not self._sorted:
+            self._sort()
+        return sum(1 for lat in self._lats if lat)
+
+    def get(self, node_id, default=None):
+        i = self._index(node_id)
+        if i is None:
+            return default
+        return _decode(self._lons[i], self._lats[i])
+
+    def close(self):
+        self.__init__()
+
+
+class DenseNodeStore(object):
+    """Keeps locations in a memory-mapped file indexed directly by node id,
+    8 bytes per possible id, with O(1) lookups. Best for continent or planet
+    sized inputs where most ids up to the maximum are in use.
+
+    If path is None an anonymous temporary file is used. The file is created
+    sparse and grows as larger ids are stored, so disk use follows the ids
+    actually written on filesystems that support holes."""
+
+    SLOT = struct.Struct('<ii')
+
+    def __init__(self, path=None, initial_ids=1 << 20):
+        if path is None:
+            self._file = tempfile.TemporaryFile()
+        else:
+            self._file = open(path, 'w+b')
+        self._map = None
+        self._size = 0
+        self._grow(initial_ids * self.SLOT.size)
+
+    def _grow(self, size):
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._size = size
+
+    def __setitem__(self, node_id, loc):
+        if node_id < 0:
+            raise ValueError('DenseNodeStore can\'t hold negative node id %d' % node_id)
+        offset = node_id * self.SLOT.size
+        if offset + self.SLOT.size > self._size:
+            self._grow(max(offset + self.SLOT.size, self._size * 2))
+        self.SLOT.pack_into(self._map, offset, *_encode(loc))
+
+    def _slot(self, node_id):
+        offset = node_id * self.SLOT.size
+        if node_id < 0 or offset + self.SLOT.size > self._size:
+            return None
+        lon, lat = self.SLOT.unpack_from(self._map, offset)
+        if not lat:
+            return None
+        return lon, lat
+
+    def __delitem__(self, node_id):
+        if self._slot(node_id) is None:
+            raise KeyError(node_id)
+        self.SLOT.pack_into(self._map, node_id * self.SLOT.size, 0, 0)
+
+    def __contains__(self, node_id):
+        return self._slot(node_id) is not None
+
+    def get(self, node_id, default=None):
+        slot = self._slot(node_id)
+        if slot is None:
+            return default
+        return _decode(*slot)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
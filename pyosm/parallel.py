@@ -0,0 +1,37 @@
+import collections
+import multiprocessing
+
+
+def imap_ordered(pool, func, iterable, max_in_flight):
+    """Like pool.imap, but only pulls from iterable when fewer than
+    max_in_flight results are outstanding, so a fast producer can't buffer
+    an entire file's worth of work in memory. Results come back in the same
+    order as their inputs."""
+
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def iter_pool_results(func, iterable, workers, max_in_flight=None):
+    """Run func over iterable in a pool of worker processes and yield the
+    results in input order. The pool is torn down when the caller stops
+    iterating."""
+
+    if max_in_flight is None:
+        max_in_flight = workers * 2
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in imap_ordered(pool, func, iterable, max_in_flight):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,19 +1,91 @@
+import array
+import calendar
+import collections
 import datetime
-import gzip
 import io
+import multiprocessing
 import os.path
+import re
 import pyosm.model as model
-import requests
+from pyosm.dataset import OsmDataset
+from pyosm.parallel import iter_pool_results
+from pyosm.scheduler import PollScheduler
+from pyosm.transport import get_transport, iter_chunks, iter_response, GzipStream
+import threading
 import time
-from lxml import etree
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+from xml.parsers import expat
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# OSM timestamps repeat a lot (every object in a changeset upload usually
+# shares one), so parsed values are kept in a small cache that is emptied
+# whenever it fills up.
+TIMESTAMP_CACHE_SIZE = 4096
+_datetime_cache = {}
+_epoch_cache = {}
+
+
+def _isoFields(s):
+    """Split a "2013-08-18T12:34:56Z" string into its integer fields."""
+    if len(s) == 20 and s[4] == '-' and s[7] == '-' and s[10] == 'T' and s[13] == ':' and s[16] == ':' and s[19] == 'Z':
+        return (int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+    else:
+        return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ").timetuple()[:6]
 
 
 def isoToDatetime(s):
     """Parse a ISO8601-formatted string to a Python datetime."""
     if s is None:
         return s
+
+    dt = _datetime_cache.get(s)
+    if dt is None:
+        dt = datetime.datetime(*_isoFields(s))
+        if len(_datetime_cache) >= TIMESTAMP_CACHE_SIZE:
+            _datetime_cache.clear()
+        _datetime_cache[s] = dt
+    return dt
+
+
+def isoToEpoch(s):
+    """Parse a ISO8601-formatted string to integer seconds since the Unix epoch."""
+    if s is None:
+        return s
+
+    ts = _epoch_cache.get(s)
+    if ts is None:
+        ts = calendar.timegm(_isoFields(s))
+        if len(_epoch_cache) >= TIMESTAMP_CACHE_SIZE:
+            _epoch_cache.clear()
+        _epoch_cache[s] = ts
+    return ts
+
+
+def timestampParser(parse_timestamps):
+    """Return the function that turns a raw timestamp attribute into what the
+    caller asked for: a datetime if parse_timestamps is True, epoch seconds if
+    it is 'epoch', or the string untouched if it is False."""
+    if parse_timestamps == 'epoch':
+        return isoToEpoch
+    elif parse_timestamps:
+        return isoToDatetime
     else:
-        return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ")
+        return _unparsedTimestamp
+
+
+def _unparsedTimestamp(s):
+    return s
 
 
 def noteTimeToDatetime(s):
@@ -51,14 +123,384 @@ def readState(state_file, sep='='):
     return state
 
 
-def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/changesets', expected_interval=60, parse_timestamps=True, state_dir=None):
+class ElementFilter(object):
+    """Describes which primitives a parser should build. The parsers evaluate
+    it on raw XML attributes so that rejected elements never have their model
+    objects, tags, nds or members constructed.
+
+    types is a collection of 'node', 'way', 'relation' and 'changeset'.
+    tags maps a tag key that must be present to either None (any value) or a
+    collection of acceptable values; every key listed must match.
+    id_range is an inclusive (min_id, max_id) pair; either end may be None.
+    bbox is (min_lon, min_lat, max_lon, max_lat) and only applies to nodes."""
+
+    def __init__(self, types=None, tags=None, id_range=None, bbox=None):
+        self.types = frozenset(types) if types is not None else None
+        if tags is not None:
+            self.tags = dict((k, frozenset(v) if v is not None else None) for k, v in tags.items())
+        else:
+            self.tags = None
+        self.id_range = id_range
+        self.bbox = bbox
+
+    def accepts_attrib(self, kind, attrib):
+        if self.types is not None and kind not in self.types:
+            return False
+
+        if self.id_range is not None:
+            min_id, max_id = self.id_range
+            element_id = int(attrib['id'])
+            if min_id is not None and element_id < min_id:
+                return False
+            if max_id is not None and element_id > max_id:
+                return False
+
+        if self.bbox is not None and kind == 'node':
+            lat = attrib.get('lat')
+            lon = attrib.get('lon')
+            if lat is None or lon is None:
+                return False
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            if not (min_lon <= float(lon) <= max_lon and min_lat <= float(lat) <= max_lat):
+                return False
+
+        return True
+
+    def accepts_tags(self, pairs):
+        if self.tags is None:
+            return True
+
+        tags = dict(pairs)
+        for k, values in self.tags.items():
+            if k not in tags:
+                return False
+            if values is not None and tags[k] not in values:
+                return False
+
+        return True
+
+
+def _tag_pairs(elem):
+    return [(c.get('k'), c.get('v')) for c in elem.iterchildren('tag')]
+
+
+def _tags(elem, strings):
+    key = strings.intern
+    value = strings.intern_value
+    return [model.Tag(key(c.get('k')), value(c.get('v'))) for c in elem.iterchildren('tag')]
+
+
+# The builders below turn a complete element into a model object. They're
+# looked up by tag in ELEMENT_BUILDERS, read each attribute once and only
+# visit the kinds of children they need. Strings that repeat a lot go
+# through a model.StringTable.
+
+def _build_node(elem, parse_ts, strings):
+    get = elem.get
+    return model.Node(
+        int(get('id')),
+        maybeInt(get('version')),
+        maybeInt(get('changeset')),
+        strings.intern(get('user')),
+        maybeInt(get('uid')),
+        maybeBool(get('visible')),
+        parse_ts(get('timestamp')),
+        maybeFloat(get('lat')),
+        maybeFloat(get('lon')),
+        _tags(elem, strings)
+    )
+
+
+def _build_way(elem, parse_ts, strings):
+    get = elem.get
+    return model.Way(
+        int(get('id')),
+        maybeInt(get('version')),
+        maybeInt(get('changeset')),
+        strings.intern(get('user')),
+        maybeInt(get('uid')),
+        maybeBool(get('visible')),
+        parse_ts(get('timestamp')),
+        [int(c.get('ref')) for c in elem.iterchildren('nd')],
+        _tags(elem, strings)
+    )
+
+
+def _build_relation(elem, parse_ts, strings):
+    get = elem.get
+    intern = strings.intern
+    return model.Relation(
+        int(get('id')),
+        maybeInt(get('version')),
+        maybeInt(get('changeset')),
+        strings.intern(get('user')),
+        maybeInt(get('uid')),
+        maybeBool(get('visible')),
+        parse_ts(get('timestamp')),
+        [model.Member(intern(c.get('type')), int(c.get('ref')), intern(c.get('role'))) for c in elem.iterchildren('member')],
+        _tags(elem, strings)
+    )
+
+
+def _build_changeset(elem, parse_ts, strings):
+    get = elem.get
+    return model.Changeset(
+        int(get('id')),
+        parse_ts(get('created_at')),
+        parse_ts(get('closed_at')),
+        maybeBool(get('open')),
+        maybeFloat(get('min_lat')),
+        maybeFloat(get('max_lat')),
+        maybeFloat(get('min_lon')),
+        maybeFloat(get('max_lon')),
+        strings.intern(get('user')),
+        maybeInt(get('uid')),
+        _tags(elem, strings)
+    )
+
+
+ELEMENT_BUILDERS = {
+    'node': _build_node,
+    'way': _build_way,
+    'relation': _build_relation,
+    'changeset': _build_changeset,
+}
+
+PRIMITIVE_TAGS = ('node', 'way', 'relation')
+
+CHANGE_ACTIONS = ('create', 'modify', 'delete')
+
+
+# The XML parser backends _iter_elements can use:
+#   'iterparse' - lxml's iterparse. Builds a tree that is pruned as we go.
+#   'target'    - lxml's parser calling back into _ElementCollector.
+#   'expat'     - the standard library's expat, also with _ElementCollector.
+#                 Works without lxml.
+# All of them produce identical model objects.
+XML_BACKENDS = ('iterparse', 'target', 'expat')
+
+DEFAULT_XML_BACKEND = 'iterparse' if etree is not None else 'expat'
+
+# How much of the input the callback backends read at a time
+PARSE_CHUNK_SIZE = 64 * 1024
+
+
+class _Element(object):
+    """A parsed element for the callback backends, with the parts of the
+    lxml element API the builders use."""
+
+    __slots__ = ('tag', 'attrib', 'get', 'children')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.get = attrib.get
+        self.children = []
+
+    def iterchildren(self, tag):
+        return [c for c in self.children if c.tag == tag]
+
+
+class _ElementCollector(object):
+    """Receives start and end callbacks from a push parser and collects
+    (parent tag, _Element) for each complete element whose tag is in tags.
+    Nothing outside those elements is kept."""
+
+    def __init__(self, tags):
+        self.tags = frozenset(tags)
+        self.ready = []
+        self._stack = []
+        self._current = None
+        self._current_depth = None
+        self._parent = None
+
+    def start(self, tag, attrib):
+        if self._current is not None:
+            self._current.children.append(_Element(tag, attrib))
+        elif tag in self.tags:
+            self._current = _Element(tag, attrib)
+            self._current_depth = len(self._stack)
+            self._parent = self._stack[-1] if self._stack else None
+        self._stack.append(tag)
+
+    def end(self, tag):
+        self._stack.pop()
+        if self._current is not None and len(self._stack) == self._current_depth:
+            self.ready.append((self._parent, self._current))
+            self._current = None
+
+    def close(self):
+        pass
+
+
+def _require_lxml(what):
+    if etree is None:
+        raise Exception('%s needs lxml, which isn\'t installed.' % what)
+
+
+def _iter_collected(f, collector, feed, finish):
+    while True:
+        data = f.read(PARSE_CHUNK_SIZE)
+        if not data:
+            break
+        feed(data)
+
+        if collector.ready:
+            ready, collector.ready = collector.ready, []
+            for item in ready:
+                yield item
+
+    finish(data)
+    for item in collector.ready:
+        yield item
+
+
+def _iter_elements(f, tags, backend=None):
+    """Yield (parent tag, element) for every complete element of f whose tag
+    is in tags, using the named backend from XML_BACKENDS. Elements are
+    freed once the caller asks for the next one, so memory use stays flat."""
+
+    backend = backend or DEFAULT_XML_BACKEND
+
+    if backend == 'iterparse':
+        _require_lxml('The iterparse backend')
+        return _iter_lxml_elements(f, tags)
+    elif backend == 'target':
+        _require_lxml('The target backend')
+        collector = _ElementCollector(tags)
+        parser = etree.XMLParser(target=collector)
+        return _iter_collected(f, collector, parser.feed, lambda data: parser.close())
+    elif backend == 'expat':
+        collector = _ElementCollector(tags)
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = collector.start
+        parser.EndElementHandler = collector.end
+        return _iter_collected(f, collector, parser.Parse, lambda data: parser.Parse(data, True))
+    else:
+        raise Exception('Unknown XML parser backend "%s", expected one of %s.' % (backend, ', '.join(XML_BACKENDS)))
+
+
+def _iter_lxml_elements(f, tags):
+    for _, elem in etree.iterparse(f, events=('end',), tag=tags):
+        parent = elem.getparent()
+        yield parent.tag if parent is not None else None, elem
+
+        # Free this element and everything before it
+        elem.clear()
+        while parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+            elem = parent
+            parent = elem.getparent()
+
+
+def _iter_built(f, tags, parse_timestamps, compact, element_filter, backend=None, strings=None):
+    """The loop shared by the XML parsers: yield (parent tag, model object)
+    for each element of f with a tag in tags that element_filter accepts."""
+    parse_ts = timestampParser(parse_timestamps)
+    strings = strings if strings is not None else model.default_string_table
+    builders = ELEMENT_BUILDERS
+    for parent_tag, elem in _iter_elements(f, tags, backend):
+        kind = elem.tag
+
+        if element_filter is not None:
+            if not element_filter.accepts_attrib(kind, elem.attrib):
+                continue
+            if element_filter.tags is not None and not element_filter.accepts_tags(_tag_pairs(elem)):
+                continue
+
+        obj = builders[kind](elem, parse_ts, strings)
+        yield parent_tag, model.compact(obj) if compact else obj
+
+
+def sequenceUrl(base_url, sequence, suffix):
+    """Build the URL of a replication file, e.g. base/000/123/456.osc.gz."""
+    sqnStr = str(sequence).zfill(9)
+    return '%s/%s/%s/%s.%s' % (base_url, sqnStr[0:3], sqnStr[3:6], sqnStr[6:9], suffix)
+
+
+def _fetch_state(transport, cache, base_url, sequence):
+    """Return the text of a sequence's state.txt, or None if it hasn't been
+    published yet."""
+    if cache is not None:
+        data = cache.get(base_url, sequence, 'state.txt')
+        if data is not None:
+            return data.decode('utf-8')
+
+    u = transport.get(sequenceUrl(base_url, sequence, 'state.txt'))
+    if u.status_code == 404:
+        return None
+    u.raise_for_status()
+
+    if cache is not None:
+        cache.put(base_url, sequence, 'state.txt', u.content)
+    return u.text
+
+
+def _open_replication_file(transport, cache, base_url, sequence, suffix):
+    """Return a GzipStream over a gzipped replication file, or None if it
+    hasn't been published yet. Downloads are streamed and, if there is a
+    cache, written to it as they're read."""
+    if cache is not None:
+        data = cache.get(base_url, sequence, suffix)
+        if data is not None:
+            return GzipStream(iter_chunks(data))
+
+    response = transport.get(sequenceUrl(base_url, sequence, suffix), stream=True)
+    if response.status_code == 404:
+        response.close()
+        return None
+    response.raise_for_status()
+
+    chunks = iter_response(response)
+    if cache is not None:
+        chunks = cache.tee(base_url, sequence, suffix, chunks)
+    return GzipStream(chunks)
+
+
+def _fetch_diff(args):
+    """Fetch the state file and diff for one sequence number. Returns None if
+    the sequence hasn't been published yet. Runs in a prefetch thread."""
+    base_url, sequence, transport, cache = args
+
+    state_text = _fetch_state(transport, cache, base_url, sequence)
+    if state_text is None:
+        return None
+
+    content = None
+    if cache is not None:
+        content = cache.get(base_url, sequence, 'osc.gz')
+    if content is None:
+        response = transport.get(sequenceUrl(base_url, sequence, 'osc.gz'))
+        response.raise_for_status()
+        content = response.content
+        if cache is not None:
+            cache.put(base_url, sequence, 'osc.gz', content)
+
+    return (state_text, content)
+
+
+def iter_changeset_file(f, parse_timestamps=True, backend=None, strings=None):
+    """Parse a file-like containing OSM changeset XML (as in the changeset
+    replication files) and yield one Changeset at a time to the caller."""
+
+    for _, obj in _iter_built(f, ('changeset',), parse_timestamps, False, None, backend, strings):
+        yield obj
+
+
+def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/changesets', expected_interval=60, parse_timestamps=True, state_dir=None, transport=None, cache=None):
     """Start processing an OSM changeset stream and yield one (action, primitive) tuple
-    at a time to the caller."""
+    at a time to the caller.
+
+    If cache is a pyosm.cache.DiffCache, changeset files are read from it
+    when present and saved to it when downloaded."""
 
     # This is a lot like the other osm_stream except there's no
     # state file for each of the diffs, so just push ahead until
     # we run into a 404.
 
+    transport = get_transport(transport)
+
     # If the user specifies a state_dir, read the state from the statefile there
     if state_dir:
         if not os.path.exists(state_dir):
@@ -66,12 +508,12 @@ def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap
 
         if os.path.exists('%s/state.yaml' % state_dir):
             with open('%s/state.yaml' % state_dir, 'r') as f:
-                state = readState(f, ': ')
+                state = readState(f.read(), ': ')
                 start_sqn = state['sequence']
 
     # If no start_sqn, assume to start from the most recent changeset file
     if not start_sqn:
-        u = requests.get('%s/state.yaml' % base_url)
+        u = transport.get('%s/state.yaml' % base_url)
         u.raise_for_status()
         state = readState(u.text, ': ')
         sequenceNumber = int(state['sequence'])
@@ -80,52 +522,24 @@ def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap
 
     interval_fudge = 0.0
     while True:
-        sqnStr = str(sequenceNumber).zfill(9)
-        url = '%s/%s/%s/%s.osm.gz' % (base_url, sqnStr[0:3], sqnStr[3:6], sqnStr[6:9])
-
         delay = 1.0
         while True:
-            content = requests.get(url)
+            gzipper = _open_replication_file(transport, cache, base_url, sequenceNumber, 'osm.gz')
 
-            if content.status_code == 404:
+            if gzipper is None:
                 time.sleep(delay)
                 delay = min(delay * 2, 13)
                 interval_fudge += delay
                 continue
 
-            content = io.BytesIO(content.content)
-            gzipper = gzip.GzipFile(fileobj=content)
             interval_fudge -= (interval_fudge / 2.0)
             break
 
-        obj = None
-        for event, elem in etree.iterparse(gzipper, events=('start', 'end')):
-            if event == 'start':
-                if elem.tag == 'changeset':
-                    obj = model.Changeset(
-                        int(elem.attrib['id']),
-                        isoToDatetime(elem.attrib.get('created_at')) if parse_timestamps else elem.attrib.get('created_at'),
-                        isoToDatetime(elem.attrib.get('closed_at')) if parse_timestamps else elem.attrib.get('closed_at'),
-                        maybeBool(elem.attrib['open']),
-                        maybeFloat(elem.get('min_lat')),
-                        maybeFloat(elem.get('max_lat')),
-                        maybeFloat(elem.get('min_lon')),
-                        maybeFloat(elem.get('max_lon')),
-                        elem.attrib.get('user'),
-                        maybeInt(elem.attrib.get('uid')),
-                        []
-                    )
-                elif elem.tag == 'tag':
-                    obj.tags.append(
-                        model.Tag(
-                            elem.attrib['k'],
-                            elem.attrib['v']
-                        )
-                    )
-            elif event == 'end':
-                if elem.tag == 'changeset':
-                    yield obj
-                    obj = None
+        try:
+            for obj in iter_changeset_file(gzipper, parse_timestamps):
+                yield obj
+        finally:
+            gzipper.close()
 
         yield model.Finished(sequenceNumber, None)
 
@@ -136,88 +550,38 @@ def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap
                 f.write('sequence: %d' % sequenceNumber)
 
 
-def iter_osm_change_file(f, parse_timestamps=True):
-    action = None
-    obj = None
-    for event, elem in etree.iterparse(f, events=('start', 'end')):
-        if event == 'start':
-            if elem.tag == 'node':
-                obj = model.Node(
-                    int(elem.attrib['id']),
-                    int(elem.attrib['version']),
-                    int(elem.attrib['changeset']),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    maybeFloat(elem.attrib.get('lat')),
-                    maybeFloat(elem.attrib.get('lon')),
-                    []
-                )
-            elif elem.tag == 'way':
-                obj = model.Way(
-                    int(elem.attrib['id']),
-                    int(elem.attrib['version']),
-                    int(elem.attrib['changeset']),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    [],
-                    []
-                )
-            elif elem.tag == 'tag':
-                obj.tags.append(
-                    model.Tag(
-                        elem.attrib['k'],
-                        elem.attrib['v']
-                    )
-                )
-            elif elem.tag == 'nd':
-                obj.nds.append(int(elem.attrib['ref']))
-            elif elem.tag == 'relation':
-                obj = model.Relation(
-                    int(elem.attrib['id']),
-                    int(elem.attrib['version']),
-                    int(elem.attrib['changeset']),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    [],
-                    []
-                )
-            elif elem.tag == 'member':
-                obj.members.append(
-                    model.Member(
-                        elem.attrib['type'],
-                        int(elem.attrib['ref']),
-                        elem.attrib['role']
-                    )
-                )
-            elif elem.tag in ('create', 'modify', 'delete'):
-                action = elem.tag
-        elif event == 'end':
-            if elem.tag == 'node':
-                yield (action, obj)
-                obj = None
-            elif elem.tag == 'way':
-                yield (action, obj)
-                obj = None
-            elif elem.tag == 'relation':
-                yield (action, obj)
-                obj = None
-            elif elem.tag in ('create', 'modify', 'delete'):
-                action = None
+def iter_osm_change_file(f, parse_timestamps=True, compact=False, element_filter=None, backend=None, strings=None):
+    """Parse a file-like containing osmChange XML and yield one (action,
+    primitive) tuple at a time to the caller, where action is 'create',
+    'modify' or 'delete'. The options are the same as for iter_osm_file."""
 
-        elem.clear()
-        while elem.getprevious() is not None:
-            del elem.getparent()[0]
+    for parent_tag, obj in _iter_built(f, PRIMITIVE_TAGS, parse_timestamps, compact, element_filter, backend, strings):
+        yield (parent_tag if parent_tag in CHANGE_ACTIONS else None, obj)
 
 
-def iter_osm_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/minute', expected_interval=60, parse_timestamps=True, state_dir=None):
+def iter_osm_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/minute', expected_interval=60, parse_timestamps=True, state_dir=None, prefetch=0, transport=None, cache=None, metrics=None):
     """Start processing an OSM diff stream and yield one changeset at a time to
-    the caller."""
+    the caller.
+
+    If prefetch is more than 0 and the stream is behind the upstream feed
+    (e.g. catching up after downtime), up to that many of the following
+    diffs are downloaded in background threads while the current one is
+    parsed. Diffs are still yielded strictly in sequence order.
+
+    If cache is a pyosm.cache.DiffCache, state files and diffs are read from
+    it when present and saved to it when downloaded.
+
+    The next state file is polled for just after it is predicted to be
+    published, based on the cadence and publish delay a PollScheduler
+    learns from the feed. If metrics is given, it is called after each diff
+    with a dict of: sequence, timestamp (of the state, in epoch seconds),
+    fetch_seconds (polling for the state file), parse_seconds (downloading
+    and parsing the diff, not counting time spent in the caller),
+    lag_seconds (how far behind upstream the diff was when finished),
+    retries (polls that found nothing yet), prefetched, and the scheduler's
+    current interval and publish_delay estimates."""
+
+    transport = get_transport(transport)
 
     # If the user specifies a state_dir, read the state from the statefile there
     if state_dir:
@@ -226,250 +590,620 @@ def iter_osm_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/r
 
         if os.path.exists('%s/state.txt' % state_dir):
             with open('%s/state.txt' % state_dir) as f:
-                state = readState(f)
+                state = readState(f.read())
                 start_sqn = state['sequenceNumber']
 
     # If no start_sqn, assume to start from the most recent diff
     if not start_sqn:
-        u = requests.get('%s/state.txt' % base_url)
+        u = transport.get('%s/state.txt' % base_url)
         state = readState(u.text)
     else:
-        sqnStr = str(start_sqn).zfill(9)
-        u = requests.get('%s/%s/%s/%s.state.txt' % (base_url, sqnStr[0:3], sqnStr[3:6], sqnStr[6:9]))
-        state = readState(u.text)
+        state = readState(_fetch_state(transport, cache, base_url, int(start_sqn)))
 
-    interval_fudge = 0.0
+    scheduler = PollScheduler(expected_interval)
+    pool = ThreadPool(prefetch) if prefetch else None
+    pending = collections.deque()
+    prefetched = None
+    fetch_seconds = 0.0
+    retries = 0
 
-    while True:
-        sqnStr = state['sequenceNumber'].zfill(9)
-        url = '%s/%s/%s/%s.osc.gz' % (base_url, sqnStr[0:3], sqnStr[3:6], sqnStr[6:9])
-        content = requests.get(url)
-        content = io.BytesIO(content.content)
-        gzipper = gzip.GzipFile(fileobj=content)
-
-        for a in iter_osm_change_file(gzipper, parse_timestamps):
-            yield a
-
-        # After parsing the OSC, check to see how much time is remaining
-        stateTs = datetime.datetime.strptime(state['timestamp'], "%Y-%m-%dT%H:%M:%SZ")
-        yield (None, model.Finished(state['sequenceNumber'], stateTs))
-
-        nextTs = stateTs + datetime.timedelta(seconds=expected_interval + interval_fudge)
-        if datetime.datetime.utcnow() < nextTs:
-            timeToSleep = (nextTs - datetime.datetime.utcnow()).total_seconds()
-        else:
-            timeToSleep = 0.0
-        time.sleep(timeToSleep)
-
-        # Then try to fetch the next state file
-        sqnStr = str(int(state['sequenceNumber']) + 1).zfill(9)
-        url = '%s/%s/%s/%s.state.txt' % (base_url, sqnStr[0:3], sqnStr[3:6], sqnStr[6:9])
-        delay = 1.0
+    try:
         while True:
-            u = requests.get(url)
+            sequence = int(state['sequenceNumber'])
+            stateTs = isoToDatetime(state['timestamp'])
+            stateEpoch = isoToEpoch(state['timestamp'])
+            scheduler.observe_state(stateEpoch)
+
+            # Only prefetch while we're clearly behind; once caught up the
+            # next diffs don't exist yet and polling for them is handled below.
+            behind = datetime.datetime.utcnow() - stateTs > datetime.timedelta(seconds=2 * expected_interval)
+            if pool and behind:
+                while len(pending) < prefetch:
+                    pending.append(pool.apply_async(_fetch_diff, ((base_url, sequence + 1 + len(pending), transport, cache),)))
+
+            # Diffs are decompressed while they're parsed. Prefetched ones are
+            # already downloaded; otherwise parsing overlaps the download.
+            was_prefetched = prefetched is not None
+            if was_prefetched:
+                gzipper = GzipStream(iter_chunks(prefetched))
+                prefetched = None
+            else:
+                gzipper = _open_replication_file(transport, cache, base_url, sequence, 'osc.gz')
+                if gzipper is None:
+                    raise Exception('Diff for sequence %d is missing although its state file exists.' % sequence)
+
+            parse_seconds = 0.0
+            try:
+                started = time.time()
+                for a in iter_osm_change_file(gzipper, parse_timestamps):
+                    parse_seconds += time.time() - started
+                    yield a
+                    started = time.time()
+                parse_seconds += time.time() - started
+            finally:
+                gzipper.close()
+
+            if metrics is not None:
+                metrics({
+                    'sequence': sequence,
+                    'timestamp': stateEpoch,
+                    'fetch_seconds': fetch_seconds,
+                    'parse_seconds': parse_seconds,
+                    'lag_seconds': time.time() - stateEpoch,
+                    'retries': retries,
+                    'prefetched': was_prefetched,
+                    'interval': scheduler.interval,
+                    'publish_delay': scheduler.publish_delay,
+                })
+
+            yield (None, model.Finished(state['sequenceNumber'], stateTs))
+
+            if pending:
+                result = pending.popleft().get()
+                if result is not None:
+                    state_text, prefetched = result
+                    if state_dir:
+                        with open('%s/state.txt' % state_dir, 'w') as f:
+                            f.write(state_text)
+                    state = readState(state_text)
+                    fetch_seconds = 0.0
+                    retries = 0
+                    continue
+
+                # We've caught up, so the rest of the prefetches will have
+                # missed too.
+                pending.clear()
+
+            time.sleep(scheduler.seconds_until_poll(stateEpoch))
+
+            # Then try to fetch the next state file
+            retries = 0
+            while True:
+                started = time.time()
+                state_text = _fetch_state(transport, cache, base_url, sequence + 1)
+                fetch_seconds = time.time() - started
+
+                if state_text is None:
+                    scheduler.missed()
+                    retries += 1
+                    time.sleep(scheduler.retry_delay(retries))
+                    continue
 
-            if u.status_code == 404:
-                time.sleep(delay)
-                delay = min(delay * 2, 13)
-                interval_fudge += delay
-                continue
+                break
 
-            interval_fudge -= (interval_fudge / 2.0)
-            break
+            scheduler.found(isoToEpoch(readState(state_text)['timestamp']))
 
-        if state_dir:
-            with open('%s/state.txt' % state_dir, 'w') as f:
-                f.write(u.text)
-            with open('%s/state.txt' % state_dir, 'r') as f:
-                state = readState(f)
+            if state_dir:
+                with open('%s/state.txt' % state_dir, 'w') as f:
+                    f.write(state_text)
+            state = readState(state_text)
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def _as_datetime(value):
+    """Turn a timestamp in any of the forms parse_timestamps can produce into
+    a datetime."""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    elif isinstance(value, int):
+        return datetime.datetime.utcfromtimestamp(value)
+    else:
+        return isoToDatetime(value)
+
+
+def _feed_queue(name, stream, q, stop):
+    """Copy a stream into a queue, tagged with its name. Runs in a thread."""
+    try:
+        for item in stream:
+            while not stop.is_set():
+                try:
+                    q.put((name, item), timeout=1.0)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                return
+        q.put((name, StopIteration()))
+    except Exception as e:
+        q.put((name, e))
+
+
+def iter_merged_stream(osm_stream=None, changeset_stream=None, max_wait=120, changeset_cache_size=100000):
+    """Follow an OSM diff stream and a changeset stream at the same time and
+    yield one interleaved, time-ordered sequence of (action, primitive,
+    changeset) tuples.
+
+    osm_stream and changeset_stream default to iter_osm_stream() and
+    iter_changeset_stream(); pass your own to pick feeds, state dirs, etc.
+
+    Changesets are yielded as (None, changeset, changeset) as soon as they
+    arrive. Each diff from osm_stream is held until the changeset stream has
+    caught up to the diff's timestamp (or for at most max_wait seconds), so
+    that when its objects are yielded as (action, primitive, changeset) the
+    changeset metadata is usually already known; it is None otherwise. The
+    diff's Finished marker is yielded as (None, Finished, None). The most
+    recent changeset_cache_size changesets are remembered for joining."""
+
+    if osm_stream is None:
+        osm_stream = iter_osm_stream()
+    if changeset_stream is None:
+        changeset_stream = iter_changeset_stream()
+
+    q = queue.Queue(maxsize=10000)
+    stop = threading.Event()
+    for name, stream in (('osm', osm_stream), ('changesets', changeset_stream)):
+        t = threading.Thread(target=_feed_queue, args=(name, stream, q, stop))
+        t.daemon = True
+        t.start()
+
+    changesets = collections.OrderedDict()
+    watermark = None
+    current = []
+    # Completed diffs waiting to be released: (arrived at, timestamp, items)
+    held = collections.deque()
+    finished = set()
+
+    try:
+        while len(finished) < 2 or held:
+            if held:
+                timeout = max(0.0, held[0][0] + max_wait - time.time())
+            else:
+                timeout = None
+
+            try:
+                name, item = q.get(timeout=timeout) if len(finished) < 2 else (None, None)
+            except queue.Empty:
+                name, item = None, None
+
+            if isinstance(item, StopIteration):
+                finished.add(name)
+                if name == 'osm' and current:
+                    held.append((time.time(), None, current))
+                    current = []
+            elif isinstance(item, Exception):
+                raise item
+            elif name == 'changesets':
+                if type(item) == model.Changeset:
+                    changesets.pop(item.id, None)
+                    changesets[item.id] = item
+                    if len(changesets) > changeset_cache_size:
+                        changesets.popitem(last=False)
+
+                    for ts in (item.created_at, item.closed_at):
+                        ts = _as_datetime(ts)
+                        if ts is not None and (watermark is None or ts > watermark):
+                            watermark = ts
+
+                    yield (None, item, item)
+            elif name == 'osm':
+                current.append(item)
+                action, obj = item
+                if type(obj) == model.Finished:
+                    held.append((time.time(), obj.timestamp, current))
+                    current = []
+
+            while held:
+                arrived, ts, items = held[0]
+                caught_up = ts is not None and watermark is not None and watermark >= ts
+                if not (caught_up or time.time() - arrived >= max_wait or 'changesets' in finished):
+                    break
+
+                held.popleft()
+                for action, obj in items:
+                    yield (action, obj, changesets.get(getattr(obj, 'changeset', None)))
+    finally:
+        stop.set()
+
+
+def _replay_sequence(args):
+    """Fetch and parse one diff for replay_osm_diffs. Runs in a worker process."""
+    base_url, sequence, parse_timestamps, process, cache = args
+
+    transport = get_transport()
+    gzipper = _open_replication_file(transport, cache, base_url, sequence, 'osc.gz')
+    if gzipper is None:
+        raise Exception('Diff for sequence %d has not been published.' % sequence)
+
+    try:
+        changes = iter_osm_change_file(gzipper, parse_timestamps)
+        if process is not None:
+            return process(sequence, changes)
         else:
-            state = readState(u.text)
+            return list(changes)
+    finally:
+        gzipper.close()
+
+
+def replay_osm_diffs(start_sqn, end_sqn, base_url='https://planet.openstreetmap.org/replication/minute', parse_timestamps=True, workers=4, process=None, cache=None):
+    """Fetch and parse the diffs for sequence numbers start_sqn through end_sqn
+    (inclusive) in a pool of worker processes and yield one (sequence, result)
+    tuple per diff, in sequence order.
+
+    By default result is the list of (action, primitive) tuples in the diff.
+    If process is given it is called in the worker as process(sequence,
+    changes), where changes iterates over those tuples, and its return value
+    becomes the result. That keeps the per-object work in parallel and avoids
+    sending every primitive back to this process. process must be picklable,
+    i.e. a module-level function.
+
+    If cache is a pyosm.cache.DiffCache, diffs are read from it when present
+    and saved to it when downloaded."""
 
+    jobs = ((base_url, sequence, parse_timestamps, process, cache) for sequence in range(int(start_sqn), int(end_sqn) + 1))
+    sequence = int(start_sqn)
+    for result in iter_pool_results(_replay_sequence, jobs, workers):
+        yield (sequence, result)
+        sequence += 1
 
-def iter_osm_file(f, parse_timestamps=True):
+
+def iter_osm_file(f, parse_timestamps=True, compact=False, element_filter=None, backend=None, strings=None):
     """Parse a file-like containing OSM XML and yield one OSM primitive at a time
-    to the caller."""
-
-    obj = None
-    for event, elem in etree.iterparse(f, events=('start', 'end')):
-        if event == 'start':
-            if elem.tag == 'node':
-                obj = model.Node(
-                    int(elem.attrib['id']),
-                    maybeInt(elem.get('version')),
-                    maybeInt(elem.get('changeset')),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    maybeFloat(elem.get('lat')),
-                    maybeFloat(elem.get('lon')),
-                    []
-                )
-            elif elem.tag == 'way':
-                obj = model.Way(
-                    int(elem.attrib['id']),
-                    maybeInt(elem.get('version')),
-                    maybeInt(elem.get('changeset')),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    [],
-                    []
-                )
-            elif elem.tag == 'tag':
-                obj.tags.append(
-                    model.Tag(
-                        elem.attrib['k'],
-                        elem.attrib['v']
-                    )
-                )
-            elif elem.tag == 'nd':
-                obj.nds.append(int(elem.attrib['ref']))
-            elif elem.tag == 'relation':
-                obj = model.Relation(
-                    int(elem.attrib['id']),
-                    maybeInt(elem.get('version')),
-                    maybeInt(elem.get('changeset')),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    [],
-                    []
-                )
-            elif elem.tag == 'member':
-                obj.members.append(
-                    model.Member(
-                        elem.attrib['type'],
-                        int(elem.attrib['ref']),
-                        elem.attrib['role']
-                    )
-                )
-            elif elem.tag == 'changeset':
-                obj = model.Changeset(
-                    int(elem.attrib['id']),
-                    isoToDatetime(elem.attrib.get('created_at')) if parse_timestamps else elem.attrib.get('created_at'),
-                    isoToDatetime(elem.attrib.get('closed_at')) if parse_timestamps else elem.attrib.get('closed_at'),
-                    maybeBool(elem.attrib['open']),
-                    maybeFloat(elem.get('min_lat')),
-                    maybeFloat(elem.get('max_lat')),
-                    maybeFloat(elem.get('min_lon')),
-                    maybeFloat(elem.get('max_lon')),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    []
-                )
-        elif event == 'end':
-            if elem.tag == 'node':
-                yield obj
-                obj = None
-            elif elem.tag == 'way':
-                yield obj
-                obj = None
-            elif elem.tag == 'relation':
-                yield obj
-                obj = None
-            elif elem.tag == 'changeset':
-                yield obj
-                obj = None
+    to the caller.
 
-        elem.clear()
-        while elem.getprevious() is not None:
-            del elem.getparent()[0]
+    parse_timestamps may be True for datetimes, 'epoch' for integer seconds
+    since the epoch, or False to leave timestamps as strings.
+    If compact is True, nodes, ways and relations are yielded as the
+    memory-saving CompactNode, CompactWay and CompactRelation instead.
+    If element_filter is an ElementFilter, only the primitives it accepts are
+    built and yielded.
+    backend picks the XML parser, one of XML_BACKENDS. The default is lxml's
+    iterparse, or expat if lxml isn't installed.
+    Tag keys, short tag values, member types and roles and user names are
+    shared through strings, a model.StringTable, or through
+    model.default_string_table if it isn't given."""
+
+    for _, obj in _iter_built(f, PRIMITIVE_TAGS + ('changeset',), parse_timestamps, compact, element_filter, backend, strings):
+        yield obj
 
 
-def parse_osm_file(f, parse_timestamps=True):
+def parse_osm_file(f, parse_timestamps=True, compact=False, backend=None, strings=None):
     """Parse a file-like containing OSM XML into memory and return an object with
-    the nodes, ways, and relations it contains. """
+    the nodes, ways, and relations it contains. Pass compact=True to hold
+    them as compact objects (see iter_osm_file).
+
+    The result is a pyosm.dataset.OsmDataset, which unpacks like a (nodes,
+    ways, relations) tuple and can also look things up by id, referenced
+    node, member and tag."""
 
     nodes = []
     ways = []
     relations = []
 
-    for p in iter_osm_file(f, parse_timestamps):
+    for p in iter_osm_file(f, parse_timestamps, compact, backend=backend, strings=strings):
 
-        if type(p) == model.Node:
+        if isinstance(p, (model.Node, model.CompactNode)):
             nodes.append(p)
-        elif type(p) == model.Way:
+        elif isinstance(p, (model.Way, model.CompactWay)):
             ways.append(p)
-        elif type(p) == model.Relation:
+        elif isinstance(p, (model.Relation, model.CompactRelation)):
             relations.append(p)
 
-    return (nodes, ways, relations)
+    return OsmDataset(nodes, ways, relations)
+
+
+# Where a top level element starts. OSM XML never nests these inside each
+# other and a "<" can't appear unescaped in attribute values, so any match
+# is a safe place to split a file.
+ELEMENT_START = re.compile(b'<(?:node|way|relation|changeset)[ \t\r\n/>]')
 
+SPLIT_SCAN_SIZE = 1 << 20
 
-def get_note(note_id, parse_timestamps=True):
-    u = requests.get('https://www.openstreetmap.org/api/0.6/notes/%d' % note_id)
+
+def _find_element_start(f, offset, end):
+    """Return the offset of the first top level element at or after offset,
+    or end if there is none before it."""
+    # Matches are at most a dozen bytes, so overlap reads by that much
+    overlap = 16
+    while offset < end:
+        f.seek(offset)
+        data = f.read(min(SPLIT_SCAN_SIZE, end - offset))
+        match = ELEMENT_START.search(data)
+        if match:
+            return offset + match.start()
+        if len(data) <= overlap:
+            break
+        offset += len(data) - overlap
+    return end
+
+
+def _split_osm_file(path, chunk_size):
+    """Return the preamble of an OSM XML file (everything before its first
+    element) and a list of (start, end) byte ranges that each hold whole
+    top level elements and together hold all of them."""
+
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(max(0, size - SPLIT_SCAN_SIZE))
+        tail = f.read()
+        close = tail.rfind(b'</osm>')
+        end = size - len(tail) + close if close >= 0 else size
+
+        first = _find_element_start(f, 0, end)
+        f.seek(0)
+        preamble = f.read(first)
+
+        boundaries = [first]
+        while boundaries[-1] < end:
+            boundaries.append(_find_element_start(f, boundaries[-1] + chunk_size, end))
+
+    return preamble, list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _parse_osm_file_range(args):
+    """Parse one byte range of an OSM XML file. Runs in a worker process."""
+    path, preamble, start, end, parse_timestamps, compact, element_filter, backend = args
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    document = io.BytesIO(preamble + data + b'</osm>')
+    return list(iter_osm_file(document, parse_timestamps, compact, element_filter, backend))
+
+
+def iter_osm_file_parallel(path, parse_timestamps=True, compact=False, element_filter=None, workers=None, chunk_size=8 << 20, backend=None):
+    """Like iter_osm_file, but for an uncompressed OSM XML file on disk that
+    is big enough to be worth parsing on several cores.
+
+    The file is split into ranges of about chunk_size bytes at top level
+    element boundaries, each range is parsed in one of workers processes
+    (default: one per core) and the primitives are yielded in file order.
+    Only a couple of ranges per worker are held in memory at once."""
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    preamble, ranges = _split_osm_file(path, chunk_size)
+    tasks = ((path, preamble, start, end, parse_timestamps, compact, element_filter, backend) for start, end in ranges)
+
+    if workers > 1:
+        results = iter_pool_results(_parse_osm_file_range, tasks, workers)
+    else:
+        results = (_parse_osm_file_range(task) for task in tasks)
+
+    for primitives in results:
+        for p in primitives:
+            yield p
+
+
+MEMBER_TYPE_CODES = {'node': 0, 'way': 1, 'relation': 2}
+
+
+class _BatchBuffer(object):
+    """Accumulates the columns of one kind of OSM primitive until there are
+    enough to emit a batch."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.count = 0
+        self.id = array.array(model.ID_TYPECODE)
+        self.version = array.array(model.ID_TYPECODE)
+        self.changeset = array.array(model.ID_TYPECODE)
+        self.uid = array.array(model.ID_TYPECODE)
+        self.lat = array.array('d')
+        self.lon = array.array('d')
+        self.tag_offsets = array.array(model.ID_TYPECODE, [0])
+        self.tag_keys = []
+        self.tag_values = []
+        self.nd_offsets = array.array(model.ID_TYPECODE, [0])
+        self.nds = array.array(model.ID_TYPECODE)
+        self.member_offsets = array.array(model.ID_TYPECODE, [0])
+        self.member_types = array.array('b')
+        self.member_refs = array.array(model.ID_TYPECODE)
+        self.member_roles = []
+
+    def start(self, attrib):
+        get = attrib.get
+        self.id.append(int(attrib['id']))
+        self.version.append(int(get('version', -1)))
+        self.changeset.append(int(get('changeset', -1)))
+        self.uid.append(int(get('uid', -1)))
+        if self.kind == 'node':
+            self.lat.append(float(get('lat', 'nan')))
+            self.lon.append(float(get('lon', 'nan')))
+
+    def end(self):
+        self.count += 1
+        self.tag_offsets.append(len(self.tag_keys))
+        if self.kind == 'way':
+            self.nd_offsets.append(len(self.nds))
+        elif self.kind == 'relation':
+            self.member_offsets.append(len(self.member_refs))
+
+    def to_batch(self, np):
+        def ints(a):
+            return np.frombuffer(a, dtype=np.int64) if len(a) else np.zeros(0, dtype=np.int64)
+
+        def floats(a):
+            return np.frombuffer(a, dtype=np.float64) if len(a) else np.zeros(0, dtype=np.float64)
+
+        def objects(l):
+            a = np.empty(len(l), dtype=object)
+            a[:] = l
+            return a
+
+        common = (ints(self.id), ints(self.version), ints(self.changeset), ints(self.uid))
+        tags = (ints(self.tag_offsets), objects(self.tag_keys), objects(self.tag_values))
+
+        if self.kind == 'node':
+            return model.NodeBatch(*(common + (floats(self.lat), floats(self.lon)) + tags))
+        elif self.kind == 'way':
+            return model.WayBatch(*(common + (ints(self.nd_offsets), ints(self.nds)) + tags))
+        else:
+            return model.RelationBatch(*(common + (
+                ints(self.member_offsets),
+                np.array(self.member_types, dtype=np.int8),
+                ints(self.member_refs),
+                objects(self.member_roles),
+            ) + tags))
+
+
+def iter_osm_batches(f, batch_size=65536, backend=None):
+    """Parse a file-like containing OSM XML and yield NodeBatch, WayBatch and
+    RelationBatch objects holding up to batch_size primitives each as NumPy
+    columns. No per-primitive objects are built, so this is much cheaper than
+    iter_osm_file when the consumer can work on whole arrays.
+
+    Missing version, changeset and uid attributes are stored as -1 and missing
+    coordinates as NaN. Member types are coded 0 (node), 1 (way) and
+    2 (relation). Batches of one kind come out in file order, but a partial
+    batch of one kind may be held back while another kind is emitted.
+    backend is as for iter_osm_file."""
+
+    import numpy as np
+
+    intern = model.default_string_table.intern
+    intern_value = model.default_string_table.intern_value
+    buffers = {}
+    for _, elem in _iter_elements(f, PRIMITIVE_TAGS, backend):
+        tag = elem.tag
+        current = buffers.get(tag)
+        if current is None:
+            current = buffers[tag] = _BatchBuffer(tag)
+
+        current.start(elem.attrib)
+        for c in elem.iterchildren('tag'):
+            current.tag_keys.append(intern(c.get('k')))
+            current.tag_values.append(intern_value(c.get('v')))
+        if tag == 'way':
+            current.nds.extend(int(c.get('ref')) for c in elem.iterchildren('nd'))
+        elif tag == 'relation':
+            for c in elem.iterchildren('member'):
+                current.member_types.append(MEMBER_TYPE_CODES[c.get('type')])
+                current.member_refs.append(int(c.get('ref')))
+                current.member_roles.append(intern(c.get('role')))
+        current.end()
+
+        if current.count >= batch_size:
+            yield current.to_batch(np)
+            buffers[tag] = None
+
+    for kind in ('node', 'way', 'relation'):
+        if buffers.get(kind) is not None:
+            yield buffers[kind].to_batch(np)
+
+
+NOTES_API_URL = 'https://www.openstreetmap.org/api/0.6/notes'
+
+
+def get_note(note_id, parse_timestamps=True, transport=None):
+    transport = get_transport(transport)
+    u = transport.get('%s/%d' % (NOTES_API_URL, note_id))
     u.raise_for_status()
-    tree = etree.fromstring(u.content)
-    note_elem = tree.xpath('/osm/note')[0]
+    return parseNote(u.content, parse_timestamps)
+
+
+def _xml_fromstring(content):
+    if etree is not None:
+        return etree.fromstring(content)
+    return ElementTree.fromstring(content)
+
+
+def parseNote(content, parse_timestamps=True):
+    """Parse the XML of a single note from the notes API into a Note."""
+    note_elem = _xml_fromstring(content).find('note')
+
+    def parse_time(elem):
+        return noteTimeToDatetime(elem.text) if parse_timestamps else elem.text
 
     def parse_comment(comment_element):
-        user_elem = comment_element.xpath('user')
-        uid_elem = comment_element.xpath('uid')
+        user_elem = comment_element.find('user')
+        uid_elem = comment_element.find('uid')
         return model.Comment(
-            created_at=noteTimeToDatetime(comment_element.xpath('date')[0].text) if parse_timestamps else comment_element.xpath('date')[0].text,
-            user=user_elem[0].text if user_elem else None,
-            uid=int(uid_elem[0].text) if uid_elem else None,
-            action=comment_element.xpath('action')[0].text,
-            text=comment_element.xpath('text')[0].text
+            created_at=parse_time(comment_element.find('date')),
+            user=user_elem.text if user_elem is not None else None,
+            uid=int(uid_elem.text) if uid_elem is not None else None,
+            action=comment_element.find('action').text,
+            text=comment_element.find('text').text
         )
 
-    closed_elem = note_elem.xpath('date_closed')
-    if closed_elem:
-        closed_at = noteTimeToDatetime(closed_elem[0].text) if parse_timestamps else closed_elem[0].text
+    closed_elem = note_elem.find('date_closed')
+    if closed_elem is not None:
+        closed_at = parse_time(closed_elem)
     else:
         closed_at = None
 
     return model.Note(
-        id=int(note_elem.xpath('id')[0].text),
+        id=int(note_elem.find('id').text),
         lat=float(note_elem.attrib['lat']),
         lon=float(note_elem.attrib['lon']),
-        created_at=noteTimeToDatetime(note_elem.xpath('date_created')[0].text) if parse_timestamps else note_elem.xpath('date_created')[0].text,
+        created_at=parse_time(note_elem.find('date_created')),
         closed_at=closed_at,
-        status=note_elem.xpath('status')[0].text,
-        comments=[parse_comment(c) for c in note_elem.xpath('comments/comment')]
+        status=note_elem.find('status').text,
+        comments=[parse_comment(c) for c in note_elem.findall('comments/comment')]
     )
 
 
-def iter_osm_notes(feed_limit=25, interval=60, parse_timestamps=True):
+def parseNotesFeed(content, last_seen_guid):
+    """Parse the notes RSS feed and return ([(action, note id), ...] for the
+    items newer than last_seen_guid, newest first, and the new last seen
+    guid)."""
+    tree = _xml_fromstring(content)
+
+    new_note_ids = []
+    for note_item in tree.findall('channel/item'):
+        title = note_item.find('title').text
+
+        if title.startswith('new note ('):
+            action = 'create'
+        elif title.startswith('new comment ('):
+            action = 'comment'
+        elif title.startswith('closed note ('):
+            action = 'close'
+
+        # Note that (at least for now) the link and guid are the same in the feed.
+        guid = note_item.find('link').text
+
+        if last_seen_guid == guid:
+            break
+        elif last_seen_guid is None:
+            # The first time through we want the first item to be the "last seen"
+            # because the RSS feed is newest-to-oldest
+            last_seen_guid = guid
+        else:
+            note_id = int(guid.split('/')[-1].split('#c')[0])
+            new_note_ids.append((action, note_id))
+
+    return new_note_ids, last_seen_guid
+
+
+def iter_osm_notes(feed_limit=25, interval=60, parse_timestamps=True, transport=None):
     """ Parses the global OSM Notes feed and yields as much Note information as possible. """
 
+    transport = get_transport(transport)
+
     last_seen_guid = None
     while True:
-        u = requests.get(
-            'https://www.openstreetmap.org/api/0.6/notes/feed',
+        u = transport.get(
+            '%s/feed' % NOTES_API_URL,
             params=dict(limit=feed_limit),
         )
         u.raise_for_status()
 
-        tree = etree.fromstring(u.content)
-
-        new_notes = []
-        for note_item in tree.xpath('/rss/channel/item'):
-            title = note_item.xpath('title')[0].text
-
-            if title.startswith('new note ('):
-                action = 'create'
-            elif title.startswith('new comment ('):
-                action = 'comment'
-            elif title.startswith('closed note ('):
-                action = 'close'
-
-            # Note that (at least for now) the link and guid are the same in the feed.
-            guid = note_item.xpath('link')[0].text
-
-            if last_seen_guid == guid:
-                break
-            elif last_seen_guid is None:
-                # The first time through we want the first item to be the "last seen"
-                # because the RSS feed is newest-to-oldest
-                last_seen_guid = guid
-            else:
-                note_id = int(guid.split('/')[-1].split('#c')[0])
-                new_notes.append((action, get_note(note_id, parse_timestamps)))
+        new_note_ids, last_seen_guid = parseNotesFeed(u.content, last_seen_guid)
+        new_notes = [(action, get_note(note_id, parse_timestamps, transport)) for action, note_id in new_note_ids]
 
         # We yield the reversed list because we want to yield in change order
         # (i.e. "oldest to most current")
@@ -0,0 +1,400 @@
+import datetime
+import struct
+import zlib
+import pyosm.model as model
+from pyosm.parallel import iter_pool_results
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# The PBF format is a sequence of protocol buffer messages. Rather than pull
+# in a protobuf compiler and generated code, the handful of messages we need
+# are decoded by hand below. Field numbers come from fileformat.proto and
+# osmformat.proto in the OSM-binary project.
+
+SUPPORTED_FEATURES = set([
+    'OsmSchema-V0.6',
+    'DenseNodes',
+    'HistoricalInformation',
+])
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _signed(n):
+    """Interpret an unsigned varint as a two's complement int64."""
+    return n - (1 << 64) if n & (1 << 63) else n
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _decode_message(buf):
+    """Decode a protobuf message into a dict of field number to a list of raw
+    values. Varints are returned as unsigned ints and length-delimited fields
+    as bytearray slices."""
+
+    fields = {}
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        wire_type = key & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = struct.unpack('<Q', bytes(buf[pos:pos + 8]))[0]
+            pos += 8
+        elif wire_type == 5:
+            value = struct.unpack('<I', bytes(buf[pos:pos + 4]))[0]
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type %d' % wire_type)
+
+        fields.setdefault(key >> 3, []).append(value)
+
+    return fields
+
+
+def _packed(buf):
+    """Decode a packed repeated varint field."""
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        result = 0
+        shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+
+def _packed_fields(fields, number):
+    """Return all values of a repeated varint field, packed or not."""
+    values = []
+    for v in fields.get(number, ()):
+        if isinstance(v, bytearray):
+            values.extend(_packed(v))
+        else:
+            values.append(v)
+    return values
+
+
+def _delta_zigzag(values):
+    """Undo the zigzag and delta coding used for ids, refs and coordinates."""
+    out = []
+    append = out.append
+    last = 0
+    for v in values:
+        last += (v >> 1) ^ -(v & 1)
+        append(last)
+    return out
+
+
+def _first(fields, number, default=None):
+    values = fields.get(number)
+    return values[0] if values else default
+
+
+def _iter_blobs(f):
+    """Yield (blob type, raw blob bytes) for every fileblock in a PBF file."""
+
+    while True:
+        size = f.read(4)
+        if not size:
+            break
+        if len(size) < 4:
+            raise ValueError('Truncated PBF blob header length')
+
+        header = _decode_message(bytearray(f.read(struct.unpack('!I', size)[0])))
+        blob_type = bytes(_first(header, 1)).decode('utf-8')
+        datasize = _first(header, 3)
+
+        data = f.read(datasize)
+        if len(data) < datasize:
+            raise ValueError('Truncated PBF blob')
+
+        yield blob_type, data
+
+
+def _decompress_blob(data):
+    blob = _decode_message(bytearray(data))
+
+    if 1 in blob:
+        return blob[1][0]
+    elif 3 in blob:
+        return bytearray(zlib.decompress(bytes(blob[3][0])))
+    elif 4 in blob:
+        if lzma is None:
+            raise ValueError('PBF blob is LZMA compressed but the lzma module is not available')
+        return bytearray(lzma.decompress(bytes(blob[4][0])))
+    else:
+        raise ValueError('Unsupported PBF blob compression')
+
+
+def _check_header(data):
+    header = _decode_message(data)
+    for feature in header.get(4, ()):
+        feature = bytes(feature).decode('utf-8')
+        if feature not in SUPPORTED_FEATURES:
+            raise ValueError('PBF file requires unsupported feature "%s"' % feature)
+
+
+class _Block(object):
+    """Block-wide decoding state for a PrimitiveBlock."""
+
+    def __init__(self, fields, parse_timestamps):
+        # The string table holds keys, values, roles and user names alike
+        intern = model.default_string_table.intern_value
+        self.strings = [intern(bytes(s).decode('utf-8')) for s in _decode_message(_first(fields, 1, bytearray())).get(1, ())]
+        self.granularity = _first(fields, 17, 100)
+        self.date_granularity = _first(fields, 18, 1000)
+        self.lat_offset = _signed(_first(fields, 19, 0))
+        self.lon_offset = _signed(_first(fields, 20, 0))
+        self.parse_timestamps = parse_timestamps
+
+    def coordinate(self, offset, value):
+        return (offset + self.granularity * value) / 1e9
+
+    def timestamp(self, value):
+        if value is None:
+            return None
+
+        seconds = value * self.date_granularity // 1000
+        if self.parse_timestamps == 'epoch':
+            return seconds
+
+        ts = EPOCH + datetime.timedelta(seconds=seconds)
+        if self.parse_timestamps:
+            return ts
+        else:
+            return ts.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def tags(self, fields):
+        strings = self.strings
+        keys = _packed_fields(fields, 2)
+        vals = _packed_fields(fields, 3)
+        return [model.Tag(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+    def info(self, fields):
+        """Return (version, changeset, user, uid, visible, timestamp) from an Info message."""
+        if 4 not in fields:
+            return (None, None, None, None, None, None)
+
+        info = _decode_message(fields[4][0])
+        version = _first(info, 1)
+        timestamp = _first(info, 2)
+        changeset = _first(info, 3)
+        uid = _first(info, 4)
+        user_sid = _first(info, 5)
+        visible = _first(info, 6)
+
+        return (
+            version,
+            _signed(changeset) if changeset is not None else None,
+            self.strings[user_sid] if user_sid is not None else None,
+            _signed(uid) if uid is not None else None,
+            bool(visible) if visible is not None else None,
+            self.timestamp(_signed(timestamp) if timestamp is not None else None),
+        )
+
+
+def _decode_dense(block, dense):
+    fields = _decode_message(dense)
+    ids = _delta_zigzag(_packed_fields(fields, 1))
+    lats = _delta_zigzag(_packed_fields(fields, 8))
+    lons = _delta_zigzag(_packed_fields(fields, 9))
+    keys_vals = _packed_fields(fields, 10)
+
+    count = len(ids)
+    if 5 in fields:
+        info = _decode_message(fields[5][0])
+        versions = _packed_fields(info, 1)
+        timestamps = _delta_zigzag(_packed_fields(info, 2))
+        changesets = _delta_zigzag(_packed_fields(info, 3))
+        uids = _delta_zigzag(_packed_fields(info, 4))
+        user_sids = _delta_zigzag(_packed_fields(info, 5))
+        visibles = _packed_fields(info, 6)
+    else:
+        versions = timestamps = changesets = uids = user_sids = visibles = ()
+
+    strings = block.strings
+    granularity = block.granularity
+    lat_offset = block.lat_offset
+    lon_offset = block.lon_offset
+
+    kv = 0
+    for i in range(count):
+        tags = []
+        if keys_vals:
+            while keys_vals[kv] != 0:
+                tags.append(model.Tag(strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+                kv += 2
+            kv += 1
+
+        yield model.Node(
+            ids[i],
+            versions[i] if versions else None,
+            changesets[i] if changesets else None,
+            strings[user_sids[i]] if user_sids else None,
+            uids[i] if uids else None,
+            bool(visibles[i]) if visibles else None,
+            block.timestamp(timestamps[i]) if timestamps else None,
+            (lat_offset + granularity * lats[i]) / 1e9,
+            (lon_offset + granularity * lons[i]) / 1e9,
+            tags
+        )
+
+
+def _decode_node(block, node):
+    fields = _decode_message(node)
+    version, changeset, user, uid, visible, timestamp = block.info(fields)
+    return model.Node(
+        _zigzag(_first(fields, 1)),
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        block.coordinate(block.lat_offset, _zigzag(_first(fields, 8))),
+        block.coordinate(block.lon_offset, _zigzag(_first(fields, 9))),
+        block.tags(fields)
+    )
+
+
+def _decode_way(block, way):
+    fields = _decode_message(way)
+    version, changeset, user, uid, visible, timestamp = block.info(fields)
+    return model.Way(
+        _signed(_first(fields, 1)),
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        _delta_zigzag(_packed_fields(fields, 8)),
+        block.tags(fields)
+    )
+
+
+def _decode_relation(block, relation):
+    fields = _decode_message(relation)
+    version, changeset, user, uid, visible, timestamp = block.info(fields)
+    strings = block.strings
+    roles = _packed_fields(fields, 8)
+    refs = _delta_zigzag(_packed_fields(fields, 9))
+    types = _packed_fields(fields, 10)
+    return model.Relation(
+        _signed(_first(fields, 1)),
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        [model.Member(MEMBER_TYPES[t], r, strings[s]) for t, r, s in zip(types, refs, roles)],
+        block.tags(fields)
+    )
+
+
+def _iter_primitive_block(data, parse_timestamps):
+    fields = _decode_message(data)
+    block = _Block(fields, parse_timestamps)
+
+    for group in fields.get(2, ()):
+        group = _decode_message(group)
+        for node in group.get(1, ()):
+            yield _decode_node(block, node)
+        for dense in group.get(2, ()):
+            for node in _decode_dense(block, dense):
+                yield node
+        for way in group.get(3, ()):
+            yield _decode_way(block, way)
+        for relation in group.get(4, ()):
+            yield _decode_relation(block, relation)
+
+
+def _iter_data_blobs(f):
+    """Yield the raw OSMData blobs of a PBF file, checking headers on the way."""
+
+    for blob_type, data in _iter_blobs(f):
+        if blob_type == 'OSMHeader':
+            _check_header(_decompress_blob(data))
+        elif blob_type == 'OSMData':
+            yield data
+
+
+def _accepts(element_filter, p):
+    """Apply a pyosm.parsing.ElementFilter to a decoded primitive."""
+    kind = type(p).__name__.lower()
+    attrib = {'id': p.id}
+    if kind == 'node':
+        attrib['lat'] = p.lat
+        attrib['lon'] = p.lon
+    return element_filter.accepts_attrib(kind, attrib) and element_filter.accepts_tags(p.tags)
+
+
+def _iter_decoded(data, parse_timestamps, element_filter):
+    primitives = _iter_primitive_block(_decompress_blob(data), parse_timestamps)
+    if element_filter is None:
+        return primitives
+    return (p for p in primitives if _accepts(element_filter, p))
+
+
+def _decode_data_blob(args):
+    """Decompress and decode one OSMData blob. Runs in a worker process."""
+    data, parse_timestamps, element_filter = args
+    return list(_iter_decoded(data, parse_timestamps, element_filter))
+
+
+def iter_osm_pbf_file(f, parse_timestamps=True, workers=None, compact=False, element_filter=None):
+    """Parse a file-like containing OSM PBF and yield one OSM primitive at a time
+    to the caller, in the same form as iter_osm_file.
+
+    If workers is more than 1, blobs are decompressed and decoded in that many
+    worker processes. Primitives are still yielded in file order and only a
+    few blobs per worker are held in memory at once.
+
+    compact and element_filter work as they do for iter_osm_file, except
+    that the filter is applied after each primitive is decoded."""
+
+    if workers and workers > 1:
+        blobs = ((data, parse_timestamps, element_filter) for data in _iter_data_blobs(f))
+        blocks = iter_pool_results(_decode_data_blob, blobs, workers)
+    else:
+        blocks = (_iter_decoded(data, parse_timestamps, element_filter) for data in _iter_data_blobs(f))
+
+    for primitives in blocks:
+        for p in primitives:
+            yield model.compact(p) if compact else p
@@ -0,0 +1,80 @@
+import collections
+import time
+
+
+class PollScheduler(object):
+    """Decides when to poll a replication feed for its next state file.
+
+    Rather than sleeping for a fixed interval plus a fudge factor, it learns
+    two things from what it sees: the feed's actual publish cadence (from the
+    gap between consecutive state timestamps) and how long after its state
+    timestamp a sequence is actually published (from when polls miss and
+    hit). It then polls just after the predicted publish time and retries
+    quickly if that was too early.
+
+    All times are seconds since the epoch."""
+
+    # Weight given to each new publish delay observation
+    SMOOTHING = 0.3
+
+    # The interval is the median of this many of the latest state gaps
+    GAP_SAMPLES = 5
+
+    # Poll this long after the predicted publish time
+    MARGIN = 0.5
+
+    def __init__(self, expected_interval=60, max_retry_delay=None):
+        self.interval = float(expected_interval)
+        self.publish_delay = 0.0
+        self.max_retry_delay = max_retry_delay if max_retry_delay is not None else max(1.0, expected_interval / 4.0)
+        self._last_state_ts = None
+        self._last_miss = None
+        self._gaps = collections.deque(maxlen=self.GAP_SAMPLES)
+
+    def observe_state(self, state_ts):
+        """Learn the publish cadence from a newly read state timestamp.
+
+        The interval is the median of the latest gaps between states, so the
+        first gap replaces expected_interval however far off it was, and
+        once there are a few a single long gap from a feed outage is
+        outvoted. With an even number of gaps the lower middle one is used,
+        since polling too early only costs a retry."""
+        if self._last_state_ts is not None:
+            gap = state_ts - self._last_state_ts
+            if gap > 0:
+                self._gaps.append(gap)
+                gaps = sorted(self._gaps)
+                self.interval = float(gaps[(len(gaps) - 1) // 2])
+        self._last_state_ts = state_ts
+
+    def next_poll(self, state_ts):
+        """When to first poll for the sequence after the one at state_ts."""
+        return state_ts + self.interval + self.publish_delay + self.MARGIN
+
+    def seconds_until_poll(self, state_ts, now=None):
+        now = time.time() if now is None else now
+        return max(0.0, self.next_poll(state_ts) - now)
+
+    def missed(self, now=None):
+        """Record a poll that found nothing published yet."""
+        self._last_miss = time.time() if now is None else now
+
+    def retry_delay(self, attempt):
+        """How long to wait before retry number attempt (starting at 1)."""
+        return min(0.5 * 2 ** (attempt - 1), self.max_retry_delay)
+
+    def found(self, state_ts, now=None):
+        """Record that the sequence with state_ts was found published at now
+        and update the publish delay estimate."""
+        now = time.time() if now is None else now
+
+        if self._last_miss is not None and self._last_miss >= state_ts:
+            # It was published somewhere between the last miss and now
+            sample = (self._last_miss + now) / 2.0 - state_ts
+            self.publish_delay += self.SMOOTHING * (sample - self.publish_delay)
+        else:
+            # We only know it was published by now; poll a little earlier
+            # next time to find out how much earlier it could have been.
+            self.publish_delay = max(0.0, min(self.publish_delay, now - state_ts) * 0.9)
+
+        self._last_miss = None
@@ -1,7 +1,12 @@
-from pyosm.parsing import iter_osm_file
-from pyosm.model import Node, Way, Relation
-from shapely.geometry import Point, LineString, Polygon
-from shapely.ops import polygonize
+import array
+import collections
+import numbers
+from pyosm.parsing import iter_osm_file, ElementFilter
+from pyosm.model import Node, Way, Relation, CompactNode, CompactWay, CompactRelation, ID_TYPECODE
+from pyosm.nodestore import DictNodeStore
+from shapely.geometry import Point, LineString, Polygon, MultiPolygon
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 
 polygon_way_tags = {
     'area': ('yes'),
@@ -13,56 +18,302 @@ def way_is_polygon(way):
     return (way.nds[-1] == next(iter(way.nds))) and any([t.key in polygon_way_tags and t.value in polygon_way_tags[t.key] for t in way.tags])
 
 
-def get_shapes(filelike):
-    shapes = []
-    node_cache = {}
+def relation_is_multipolygon(relation):
+    return any([t.key == 'type' and t.value == 'multipolygon' for t in relation.tags])
+
+
+def _way_points(way_id, nds, node_cache):
+    points = []
+    for nd in nds:
+        node_loc = node_cache.get(nd)
+        if node_loc:
+            points.append(node_loc)
+        else:
+            raise Exception("Way %s references node %s which is not parsed yet." % (way_id, nd))
+    return points
+
+
+def _way_shape(way, points):
+    if way_is_polygon(way):
+        return Polygon(points)
+    else:
+        return LineString(points)
+
+
+def build_rings(way_nds):
+    """Join lists of node ids end to end into closed rings. Ways are matched up
+    through an index of their endpoints, so this is linear in the number of
+    ways. Returns a list of rings, each a list of node ids whose first and
+    last entries are the same. Chains that can't be closed are dropped."""
+
+    rings = []
+    segments = {}
+    ends = collections.defaultdict(set)
+    for i, nds in enumerate(way_nds):
+        if len(nds) < 2:
+            continue
+        if nds[0] == nds[-1]:
+            rings.append(list(nds))
+            continue
+        segments[i] = nds
+        ends[nds[0]].add(i)
+        ends[nds[-1]].add(i)
+
+    while segments:
+        i, nds = segments.popitem()
+        ends[nds[0]].discard(i)
+        ends[nds[-1]].discard(i)
+        ring = list(nds)
+
+        while ring[0] != ring[-1]:
+            candidates = ends.get(ring[-1])
+            if not candidates:
+                break
+
+            j = candidates.pop()
+            nds = segments.pop(j)
+            ends[nds[0]].discard(j)
+            ends[nds[-1]].discard(j)
+
+            if nds[0] == ring[-1]:
+                ring.extend(nds[1:])
+            else:
+                ring.extend(reversed(nds[:-1]))
+
+        if ring[0] == ring[-1] and len(ring) >= 4:
+            rings.append(ring)
+
+    return rings
+
+
+def _tree_position(hit, positions):
+    # Shapely 2 returns indices from STRtree.query, older versions return
+    # the geometries themselves.
+    if isinstance(hit, numbers.Integral):
+        return int(hit)
+    return positions[id(hit)]
+
+
+def assemble_multipolygon(rings):
+    """Turn a list of rings (lists of (lon, lat)) into a MultiPolygon. Rings
+    are nested by containment rather than by member role, since roles are
+    often missing or wrong: rings at an even depth are outers and rings at an
+    odd depth are holes in the ring directly around them.
+
+    Candidate parents are found through an STRtree of the rings' envelopes,
+    so relations with many disjoint rings (coastlines, island groups) stay
+    close to linear."""
+
+    polygons = sorted((Polygon(r) for r in rings), key=lambda p: p.area, reverse=True)
+    tree = STRtree(polygons)
+    positions = dict((id(p), i) for i, p in enumerate(polygons))
+
+    # Each entry is (prepared polygon, depth, shell, holes)
+    placed = []
+    for i, polygon in enumerate(polygons):
+        # Only rings placed before this one are big enough to hold it. The
+        # innermost one that covers it is its parent.
+        candidates = sorted((_tree_position(hit, positions) for hit in tree.query(polygon)), reverse=True)
+
+        parent = None
+        for j in candidates:
+            if j < i and placed[j][0].covers(polygon):
+                parent = placed[j]
+                break
+
+        depth = parent[1] + 1 if parent else 0
+        if depth % 2:
+            parent[3].append(polygon.exterior.coords)
+        placed.append((prep(polygon), depth, polygon.exterior.coords, []))
+
+    return MultiPolygon([Polygon(shell, holes) for _, depth, shell, holes in placed if depth % 2 == 0])
+
+
+def _multipolygon_shape(relation, way_cache, node_cache):
+    way_nds = []
+    for member in relation.members:
+        if member.type == 'way':
+            nds = way_cache.get(member.ref)
+            if not nds:
+                raise Exception("Relation %s references way %s which is not parsed yet." % (relation.id, member.ref))
+
+            way_nds.append(nds)
+
+    rings = []
+    for ring in build_rings(way_nds):
+        points = []
+        for nd in ring:
+            node_loc = node_cache.get(nd)
+            if not node_loc:
+                raise Exception("Relation %s references node %s which is not parsed yet." % (relation.id, nd))
+            points.append(node_loc)
+        rings.append(points)
+
+    if not rings:
+        return None
+
+    return assemble_multipolygon(rings)
+
+
+def _is_seekable(filelike):
+    try:
+        return filelike.seekable()
+    except AttributeError:
+        return hasattr(filelike, 'seek')
+
+
+def _count_references(filelike, compact, parser):
+    """Read the ways and relations of a seekable file-like and count, for
+    every node, how many wanted ways use it and, for every way, how many
+    multipolygon relations use it. Nodes are skipped by the parser."""
+
+    start = filelike.tell()
+
+    way_refs = collections.Counter()
+    for relation in parser(filelike, compact=compact, element_filter=ElementFilter(types=('relation',), tags={'type': ('multipolygon',)})):
+        way_refs.update(set(m.ref for m in relation.members if m.type == 'way'))
+    filelike.seek(start)
+
+    node_refs = collections.Counter()
+    for way in parser(filelike, compact=compact, element_filter=ElementFilter(types=('way',))):
+        if any(way.tags) or way.id in way_refs:
+            node_refs.update(set(way.nds))
+    filelike.seek(start)
+
+    return node_refs, way_refs
+
+
+def _release(refs, key, cache):
+    refs[key] -= 1
+    if refs[key] <= 0:
+        del refs[key]
+        del cache[key]
+
+
+def iter_shapes(filelike, compact=False, node_store=None, release_caches=False, parser=iter_osm_file):
+    """Parse a file-like containing sorted OSM data and yield (primitive,
+    shapely geometry) pairs for tagged nodes, tagged ways and multipolygon
+    relations as soon as each one can be built.
+
+    parser reads the file. It defaults to iter_osm_file for OSM XML; pass
+    pyosm.pbf.iter_osm_pbf_file to read .osm.pbf files.
+
+    If release_caches is True and filelike is seekable, its ways and
+    relations are read once beforehand to count references. Node locations
+    and member ways are then only kept while something later in the file
+    still needs them, so memory stays proportional to what is in flight
+    rather than to the whole input. That costs an extra read of the file, so
+    it's off by default.
+
+    node_store holds node locations while ways are built. It defaults to a
+    DictNodeStore; pass a SparseNodeStore or DenseNodeStore from
+    pyosm.nodestore to handle inputs too big for a dict."""
+
+    if release_caches and _is_seekable(filelike):
+        node_refs, way_refs = _count_references(filelike, compact, parser)
+    else:
+        node_refs = way_refs = None
+
+    node_cache = node_store if node_store is not None else DictNodeStore()
     way_cache = {}
-    for thing in iter_osm_file(filelike):
-        if type(thing) == Node:
+    for thing in parser(filelike, compact=compact):
+        if isinstance(thing, (Node, CompactNode)):
             pt = (thing.lon, thing.lat)
-            shape = Point(pt)
 
-            node_cache[thing.id] = pt
+            if node_refs is None or thing.id in node_refs:
+                node_cache[thing.id] = pt
 
             if thing.tags:
-                shapes.append((thing, shape))
-
-        elif type(thing) == Way:
-            points = []
-            for nd in thing.nds:
-                node_loc = node_cache.get(nd)
-                if node_loc:
-                    points.append(node_loc)
-                else:
-                    raise Exception("Way %s references node %s which is not parsed yet." % (thing.id, nd))
-
-            if way_is_polygon(thing):
-                shape = Polygon(points)
-            else:
-                shape = LineString(points)
+                yield (thing, Point(pt))
+
+        elif isinstance(thing, (Way, CompactWay)):
+            tagged = any(thing.tags)
+            if way_refs is not None and not tagged and thing.id not in way_refs:
+                continue
+
+            points = _way_points(thing.id, thing.nds, node_cache)
+            shape = _way_shape(thing, points)
 
-            way_cache[thing.id] = points
+            if way_refs is None or thing.id in way_refs:
+                way_cache[thing.id] = array.array(ID_TYPECODE, thing.nds)
+            elif node_refs is not None:
+                for nd in set(thing.nds):
+                    _release(node_refs, nd, node_cache)
 
-            if any(thing.tags):
+            if tagged:
                 # Only include tagged things at this point. Otherwise,
                 # the shapes that are part of multipolygon relations
                 # will be included twice.
-                shapes.append((thing, shape))
-
-        elif type(thing) == Relation:
-            if any([t.key == 'type' and t.value == 'multipolygon' for t in thing.tags]):
-                parts = []
-                for member in thing.members:
-                    if member.type == 'way':
-                        shape = way_cache.get(member.ref)
-                        if not shape:
-                            raise Exception("Relation %s references way %s which is not parsed yet." % (thing.id, member.ref))
-
-                        parts.append(shape)
-
-                # Polygonize will return all the polygons created, so the
-                # inner parts of the multipolygons will be returned twice
-                # we only want the first one
-                shapes.append((thing, next(polygonize(parts))))
+                yield (thing, shape)
+
+        elif isinstance(thing, (Relation, CompactRelation)):
+            if relation_is_multipolygon(thing):
+                shape = _multipolygon_shape(thing, way_cache, node_cache)
+                if shape is not None:
+                    yield (thing, shape)
+
+                if way_refs is not None:
+                    for way_id in set(m.ref for m in thing.members if m.type == 'way'):
+                        nds = way_cache[way_id]
+                        _release(way_refs, way_id, way_cache)
+                        if way_id not in way_cache:
+                            for nd in set(nds):
+                                _release(node_refs, nd, node_cache)
+
+
+def get_shapes(filelike, compact=False, node_store=None, release_caches=False, parser=iter_osm_file):
+    """Parse a file-like containing sorted OSM data and return a list of
+    (primitive, shapely geometry) pairs for tagged nodes, tagged ways and
+    multipolygon relations. See iter_shapes."""
+
+    return list(iter_shapes(filelike, compact, node_store, release_caches, parser))
+
+
+def get_shapes_multipass(filelike, compact=False, node_store=None, parser=iter_osm_file):
+    """Like get_shapes, but reads the input three times so that it doesn't
+    need to be sorted and only the nodes and ways that end up in an output
+    geometry are ever held in memory. filelike must be seekable.
+
+    The first pass collects multipolygon relations and the ways they use,
+    the second collects wanted ways and the nodes they use, and the third
+    collects those node locations. Shapes are returned nodes first, then
+    ways, then relations. parser is used for every pass, as in iter_shapes."""
+
+    def read(element_filter):
+        filelike.seek(0)
+        return parser(filelike, compact=compact, element_filter=element_filter)
+
+    relations = list(read(ElementFilter(types=('relation',), tags={'type': ('multipolygon',)})))
+    member_way_ids = set(m.ref for r in relations for m in r.members if m.type == 'way')
+
+    ways = []
+    member_way_nds = {}
+    wanted_node_ids = set()
+    for way in read(ElementFilter(types=('way',))):
+        tagged = any(way.tags)
+        if tagged:
+            ways.append(way)
+        if way.id in member_way_ids:
+            member_way_nds[way.id] = array.array(ID_TYPECODE, way.nds)
+        if tagged or way.id in member_way_ids:
+            wanted_node_ids.update(way.nds)
+
+    shapes = []
+    node_cache = node_store if node_store is not None else DictNodeStore()
+    for node in read(ElementFilter(types=('node',))):
+        if node.id in wanted_node_ids:
+            node_cache[node.id] = (node.lon, node.lat)
+
+        if node.tags:
+            shapes.append((node, Point(node.lon, node.lat)))
+    del wanted_node_ids
+
+    for way in ways:
+        shapes.append((way, _way_shape(way, _way_points(way.id, way.nds, node_cache))))
+
+    for relation in relations:
+        shape = _multipolygon_shape(relation, member_way_nds, node_cache)
+        if shape is not None:
+            shapes.append((relation, shape))
 
     return shapes
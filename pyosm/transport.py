@@ -0,0 +1,197 @@
+import os
+import requests
+import zlib
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+USER_AGENT = 'pyosm/1.0 (http://github.com/iandees/pyosm)'
+
+# Size of the blocks read off the network when streaming a response.
+CHUNK_SIZE = 64 * 1024
+
+# Statuses worth retrying. 404 is deliberately absent: the replication
+# streams poll for files that haven't been published yet and need to see it.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class Transport(object):
+    """The HTTP client used for every network request pyosm makes. It keeps a
+    pool of keep-alive connections per host and retries connection errors and
+    transient server errors with exponential backoff.
+
+    timeout is passed to requests and may be a (connect, read) pair. retries
+    is the total number of retries per request, spaced backoff_factor * 2^n
+    seconds apart. pool_maxsize should be at least the number of threads
+    that will share the transport."""
+
+    def __init__(self, user_agent=USER_AGENT, timeout=(10, 60), retries=3, backoff_factor=0.5, pool_maxsize=10):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def _member_ended(decompressor):
+    """Whether a gzip decompressobj has read all of its member, trailer
+    included. Python 2's decompress objects have no eof attribute, so there a
+    copy is fed one more byte: it only lands in unused_data once the member
+    is over."""
+    eof = getattr(decompressor, 'eof', None)
+    if eof is not None:
+        return eof
+
+    probe = decompressor.copy()
+    try:
+        probe.decompress(b'\0')
+    except zlib.error:
+        return False
+    return bool(probe.unused_data)
+
+
+class GzipStream(object):
+    """A read-only file-like that gunzips an iterable of compressed byte
+    chunks (such as a streamed response's iter_content) as it is read, so
+    parsing can start before the download finishes and the whole file is
+    never held in memory. Concatenated gzip members are handled like gzip
+    does, and like gzip, EOFError is raised if the input ends part way
+    through a member (e.g. a cut-off download).
+
+    Only as much is decompressed as each read asks for, so memory stays
+    bounded by the read size plus one chunk of input. Pass bytes that are
+    already in memory through iter_chunks rather than as one big chunk."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # Compressed input the decompressor hasn't taken yet
+        self._pending = b''
+        # Decompressed data not yet read starts at _offset in _buffer
+        self._buffer = b''
+        self._offset = 0
+        self._eof = False
+        self._in_member = False
+
+    def _decompress(self, max_length):
+        """Return up to max_length (0 for no limit) more decompressed bytes,
+        or b'' once the input is used up."""
+        while not self._eof:
+            if self._pending:
+                data, self._pending = self._pending, b''
+            elif self._decompressor.unused_data:
+                # Another gzip member follows the one that just ended
+                data = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = next(self._chunks, None)
+                if data is None:
+                    self._eof = True
+                    ended = _member_ended(self._decompressor)
+                    out = self._decompressor.flush()
+                    if self._in_member and not ended:
+                        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+                    return out
+                if not data:
+                    continue
+
+            self._in_member = True
+            out = self._decompressor.decompress(data, max_length)
+            self._pending = self._decompressor.unconsumed_tail
+            if out:
+                return out
+        return b''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._buffer[self._offset:]]
+            while not self._eof:
+                parts.append(self._decompress(0))
+            self._buffer = b''
+            self._offset = 0
+            return b''.join(parts)
+
+        available = len(self._buffer) - self._offset
+        if available < size and not self._eof:
+            parts = [self._buffer[self._offset:]]
+            while available < size and not self._eof:
+                data = self._decompress(max(size - available, CHUNK_SIZE))
+                parts.append(data)
+                available += len(data)
+            self._buffer = b''.join(parts)
+            self._offset = 0
+
+        out = self._buffer[self._offset:self._offset + size]
+        self._offset += len(out)
+        return out
+
+    def close(self):
+        close = getattr(self._chunks, 'close', None)
+        if close is not None:
+            close()
+        self._chunks = iter(())
+        self._pending = b''
+        self._buffer = b''
+        self._offset = 0
+        self._eof = True
+
+
+def iter_chunks(data, size=CHUNK_SIZE):
+    """Yield bytes already in memory (a cached or prefetched file) in size
+    byte chunks, to be read through a GzipStream."""
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def iter_response(response):
+    """Yield the body of a streamed (stream=True) response in chunks and
+    release its connection when done or closed early."""
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            yield chunk
+    finally:
+        response.close()
+
+
+_default_transport = None
+_default_transport_pid = None
+
+
+def get_transport(transport=None):
+    """Return transport if given, otherwise the shared default Transport. Each
+    process gets its own default so that worker processes forked from a
+    parent never share its pooled connections."""
+    global _default_transport, _default_transport_pid
+
+    if transport is not None:
+        return transport
+
+    if _default_transport is None or _default_transport_pid != os.getpid():
+        _default_transport = Transport()
+        _default_transport_pid = os.getpid()
+    return _default_transport
+
+
+def set_default_transport(transport):
+    """Replace the Transport used by calls that aren't given one explicitly."""
+    global _default_transport, _default_transport_pid
+    _default_transport = transport
+    _default_transport_pid = os.getpid()
@@ -12,7 +12,16 @@ setup(
     long_description=open('README.md').read(),
     keywords=['osm', 'openstreetmap', 'xml', 'parsing'],
     install_requires=[
-        'lxml',
         'requests',
-    ]
+    ],
+    extras_require={
+        # Faster XML parsing; the standard library's expat is used without it
+        'lxml': ['lxml'],
+        # pyosm.parsing.iter_osm_batches
+        'numpy': ['numpy'],
+        # pyosm.shapeify
+        'shapely': ['shapely'],
+        # pyosm.aio
+        'aiohttp': ['aiohttp'],
+    }
 )
@@ -0,0 +1,62 @@
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """A local HTTP server for tests. respond(path, query) returns the status
+    and body bytes for a GET. Connections and requests are counted so tests
+    can check that connections are reused."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.connections = 0
+        self.requests = []
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def handle(self):
+                with server._lock:
+                    server.connections += 1
+                BaseHTTPRequestHandler.handle(self)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with server._lock:
+                    server.requests.append(self.path)
+                status, body = server.respond(url.path, parse_qs(url.query))
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._httpd = _ThreadingServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self._httpd.server_address[1]
+
+    def __enter__(self):
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,149 @@
+import threading
+import time
+import unittest
+
+from pyosm.api import Api, chunk_ids
+from pyosm.cache import ObjectCache
+from pyosm.transport import Transport
+from tests.fake_server import FakeServer
+
+
+def fake_api(delay_for=None):
+    """Respond to multi-fetches of nodes with one node per id asked for.
+    delay_for(first id) gives how long to wait before answering."""
+
+    def respond(path, query):
+        if path != '/api/0.6/nodes':
+            return 404, b''
+
+        ids = query['nodes'][0].split(',')
+        if delay_for is not None:
+            time.sleep(delay_for(int(ids[0])))
+
+        body = '<osm version="0.6">%s</osm>' % ''.join(
+            '<node id="%s" version="1" changeset="1" lat="1.0" lon="2.0"/>' % i for i in ids
+        )
+        return 200, body.encode('utf-8')
+
+    return respond
+
+
+class TestChunkIds(unittest.TestCase):
+    def test_chunks_fit(self):
+        # "1,2,3" is exactly 5 characters
+        self.assertEqual([['1', '2', '3'], ['4', '5', '6'], ['7', '8', '9'], ['10', '11']], list(chunk_ids(range(1, 12), 5)))
+
+    def test_one_over(self):
+        self.assertEqual([['1', '2'], ['3']], list(chunk_ids([1, 2, 3], 4)))
+
+    def test_long_id_gets_own_chunk(self):
+        self.assertEqual([['1'], ['123456'], ['2']], list(chunk_ids([1, 123456, 2], 3)))
+
+    def test_versioned_ids(self):
+        self.assertEqual([['1v2', '3'], ['4v5']], list(chunk_ids(['1v2', 3, '4v5'], 5)))
+
+    def test_empty(self):
+        self.assertEqual([], list(chunk_ids([])))
+
+
+class TestMultiFetch(unittest.TestCase):
+    def test_sends_ids(self):
+        with FakeServer(fake_api()) as server:
+            api = Api(server.url + '/api', transport=Transport())
+            nodes = api.get_nodes([1, 2, 3])
+
+        self.assertEqual([1, 2, 3], [n.id for n in nodes])
+        self.assertEqual(1, len(server.requests))
+        self.assertIn('nodes=1%2C2%2C3', server.requests[0])
+
+    def test_chunked_in_order(self):
+        # Earlier chunks answer slower, so they finish last
+        with FakeServer(fake_api(lambda first_id: 0.2 if first_id < 20 else 0)) as server:
+            api = Api(server.url + '/api', transport=Transport(), workers=4, max_ids_length=20)
+            ids = list(range(1, 101))
+            nodes = list(api.iter_nodes(ids))
+
+        self.assertEqual(ids, [n.id for n in nodes])
+        self.assertGreater(len(server.requests), 4)
+
+    def test_concurrent(self):
+        active = [0, 0]
+        lock = threading.Lock()
+
+        def respond(path, query):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.1)
+            with lock:
+                active[0] -= 1
+            return fake_api()(path, query)
+
+        with FakeServer(respond) as server:
+            api = Api(server.url + '/api', transport=Transport(), workers=4, max_ids_length=10)
+            nodes = api.get_nodes(range(1, 41))
+
+        self.assertEqual(40, len(nodes))
+        self.assertGreater(active[1], 1)
+
+
+def node_xml(node_id, version):
+    return '<node id="%d" version="%d" changeset="1" lat="1.0" lon="2.0"/>' % (node_id, version)
+
+
+def versioned_api(latest):
+    """Respond to single and multi-fetches of nodes whose latest version is
+    latest[id]. Multi-fetches may ask for a version with "123v2"."""
+
+    def respond(path, query):
+        parts = path.split('/')
+        if path == '/api/0.6/nodes':
+            nodes = []
+            for asked in query['nodes'][0].split(','):
+                node_id, _, version = asked.partition('v')
+                nodes.append(node_xml(int(node_id), int(version) if version else latest[int(node_id)]))
+        elif len(parts) == 5:
+            nodes = [node_xml(int(parts[4]), latest[int(parts[4])])]
+        elif len(parts) == 6:
+            nodes = [node_xml(int(parts[4]), int(parts[5]))]
+        else:
+            return 404, b''
+        return 200, ('<osm version="0.6">%s</osm>' % ''.join(nodes)).encode('utf-8')
+
+    return respond
+
+
+class TestObjectCache(unittest.TestCase):
+    def test_versioned_is_not_latest(self):
+        with FakeServer(versioned_api({1: 3})) as server:
+            api = Api(server.url + '/api', transport=Transport(), cache=ObjectCache())
+            self.assertEqual(2, api.get_node(1, 2).version)
+            self.assertEqual(3, api.get_node(1).version)
+
+        self.assertEqual(['/api/0.6/node/1/2', '/api/0.6/node/1'], server.requests)
+
+    def test_latest_is_not_other_versions(self):
+        with FakeServer(versioned_api({1: 3})) as server:
+            api = Api(server.url + '/api', transport=Transport(), cache=ObjectCache())
+            self.assertEqual(3, api.get_node(1).version)
+            self.assertEqual(2, api.get_node(1, 2).version)
+            # The latest version is also cached under its own version
+            self.assertEqual(3, api.get_node(1, 3).version)
+            self.assertEqual(3, api.get_node(1).version)
+
+        self.assertEqual(['/api/0.6/node/1', '/api/0.6/node/1/2'], server.requests)
+
+    def test_multi_fetch(self):
+        with FakeServer(versioned_api({1: 3, 2: 5})) as server:
+            api = Api(server.url + '/api', transport=Transport(), workers=1, cache=ObjectCache())
+            self.assertEqual([2, 5], [n.version for n in api.get_nodes(['1v2', 2])])
+            self.assertEqual(3, api.get_node(1).version)
+            self.assertEqual(5, api.get_node(2).version)
+            self.assertEqual(2, api.get_node(1, 2).version)
+
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual('/api/0.6/node/1', server.requests[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import shutil
+import tempfile
+import unittest
+
+from pyosm.cache import DiffCache
+from tests.test_transport import _gzip
+
+BASE_URL = 'https://planet.openstreetmap.org/replication/minute'
+
+
+class TestDiffCache(unittest.TestCase):
+    data = _gzip(b'<osmChange version="0.6">' + b'<modify/>' * 1000 + b'</osmChange>')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = DiffCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put(self):
+        self.cache.put(BASE_URL, 1, 'osc.gz', self.data)
+        self.assertEqual(self.data, self.cache.get(BASE_URL, 1, 'osc.gz'))
+
+    def test_put_truncated(self):
+        self.cache.put(BASE_URL, 1, 'osc.gz', self.data[:-4])
+        self.assertIsNone(self.cache.get(BASE_URL, 1, 'osc.gz'))
+
+    def test_tee(self):
+        chunks = [self.data[i:i + 10] for i in range(0, len(self.data), 10)]
+        self.assertEqual(chunks, list(self.cache.tee(BASE_URL, 1, 'osc.gz', chunks)))
+        self.assertEqual(self.data, self.cache.get(BASE_URL, 1, 'osc.gz'))
+
+    def test_tee_truncated(self):
+        truncated = self.data[:-4]
+        chunks = [truncated[i:i + 10] for i in range(0, len(truncated), 10)]
+        self.assertEqual(chunks, list(self.cache.tee(BASE_URL, 1, 'osc.gz', chunks)))
+        self.assertIsNone(self.cache.get(BASE_URL, 1, 'osc.gz'))
+
+
+if __name__ == '__main__':
+    unittest.main()
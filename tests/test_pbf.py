@@ -0,0 +1,67 @@
+import os.path
+import unittest
+
+from pyosm.parsing import ElementFilter, iter_osm_file
+from pyosm.pbf import iter_osm_pbf_file
+
+try:
+    import shapely
+except ImportError:
+    shapely = None
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# sample.osm.pbf holds the same data as sample.osm: a block of dense nodes,
+# a block of plain nodes, one of ways and one of relations, with negative
+# ids and refs in each.
+XML = os.path.join(FIXTURES, 'sample.osm')
+PBF = os.path.join(FIXTURES, 'sample.osm.pbf')
+
+
+def read(path, parser, **kwargs):
+    with open(path, 'rb') as f:
+        return list(parser(f, **kwargs))
+
+
+class TestPbf(unittest.TestCase):
+    def test_matches_xml(self):
+        for parse_timestamps in (True, 'epoch', False):
+            expected = read(XML, iter_osm_file, parse_timestamps=parse_timestamps)
+            self.assertEqual(expected, read(PBF, iter_osm_pbf_file, parse_timestamps=parse_timestamps))
+
+    def test_workers(self):
+        expected = read(XML, iter_osm_file)
+        self.assertEqual(expected, read(PBF, iter_osm_pbf_file, workers=2))
+
+    def test_fixture_coverage(self):
+        primitives = read(PBF, iter_osm_pbf_file)
+        kinds = [type(p).__name__ for p in primitives]
+        self.assertEqual(['Node'] * 13 + ['Way'] * 4 + ['Relation'] * 2, kinds)
+        self.assertIn(-3, [p.id for p in primitives])
+        self.assertIn(-101, [p.id for p in primitives])
+        self.assertIn(-23, [p.id for p in primitives])
+        self.assertIn(-31, [p.id for p in primitives])
+
+    def test_compact_and_filter(self):
+        for element_filter in (ElementFilter(types=('way',)), ElementFilter(tags={'type': None}), ElementFilter(id_range=(None, 0)), ElementFilter(bbox=(-0.1, 51.5, 0.0, 52.0))):
+            expected = read(XML, iter_osm_file, compact=True, element_filter=element_filter)
+            self.assertEqual(expected, read(PBF, iter_osm_pbf_file, compact=True, element_filter=element_filter))
+            self.assertEqual(expected, read(PBF, iter_osm_pbf_file, compact=True, element_filter=element_filter, workers=2))
+
+    @unittest.skipIf(shapely is None, 'shapely is not installed')
+    def test_shapes(self):
+        from pyosm.shapeify import get_shapes, get_shapes_multipass
+
+        for build in (get_shapes, get_shapes_multipass):
+            with open(XML, 'rb') as f:
+                expected = build(f)
+            with open(PBF, 'rb') as f:
+                shapes = build(f, parser=iter_osm_pbf_file)
+
+            self.assertEqual([p for p, _ in expected], [p for p, _ in shapes])
+            for (_, a), (_, b) in zip(expected, shapes):
+                self.assertTrue(a.equals(b))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+from pyosm.scheduler import PollScheduler
+
+DAY = 24 * 60 * 60
+
+
+class TestPollScheduler(unittest.TestCase):
+    def observe(self, scheduler, timestamps):
+        for ts in timestamps:
+            scheduler.observe_state(ts)
+
+    def test_learns_far_off_interval(self):
+        # A day feed followed with the minutely default
+        scheduler = PollScheduler(60)
+        self.observe(scheduler, [1000000000 + i * DAY for i in range(5)])
+        self.assertEqual(DAY, scheduler.interval)
+
+        scheduler = PollScheduler(60)
+        self.observe(scheduler, [1000000000, 1000000000 + 3600])
+        self.assertEqual(3600, scheduler.interval)
+
+    def test_outage_outvoted(self):
+        scheduler = PollScheduler(60)
+        self.observe(scheduler, [0, 60, 120, 180, 180 + 6 * 3600, 180 + 6 * 3600 + 60])
+        self.assertEqual(60, scheduler.interval)
+
+    def test_ignores_repeated_state(self):
+        scheduler = PollScheduler(30)
+        self.observe(scheduler, [0, 0, 60, 60])
+        self.assertEqual(60, scheduler.interval)
+
+
+if __name__ == '__main__':
+    unittest.main()
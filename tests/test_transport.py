@@ -0,0 +1,98 @@
+import gzip
+import io
+import unittest
+
+from pyosm.parsing import iter_osm_stream
+from pyosm.transport import GzipStream, Transport, iter_chunks
+from tests.fake_server import FakeServer
+
+
+def _gzip(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def replication_feed(last_sequence):
+    """Respond like a minutely replication feed with sequences 1 to
+    last_sequence, each modifying one node."""
+
+    def respond(path, query):
+        parts = path.strip('/').split('/')
+        if len(parts) != 4 or parts[0] != 'minute':
+            return 404, b''
+
+        sequence = int(''.join(parts[1:3]) + parts[3].split('.')[0])
+        if not 1 <= sequence <= last_sequence:
+            return 404, b''
+
+        if path.endswith('.state.txt'):
+            return 200, ('sequenceNumber=%d\ntimestamp=2020-01-01T00\\:%02d\\:00Z\n' % (sequence, sequence)).encode('utf-8')
+        elif path.endswith('.osc.gz'):
+            return 200, _gzip((
+                '<osmChange version="0.6"><modify>'
+                '<node id="%d" version="2" changeset="1" lat="1.0" lon="2.0"/>'
+                '</modify></osmChange>' % sequence
+            ).encode('utf-8'))
+        return 404, b''
+
+    return respond
+
+
+class TestGzipStream(unittest.TestCase):
+    xml = b'<osm version="0.6">' + b'<node id="1" lat="1.0" lon="2.0"/>' * 5000 + b'</osm>'
+
+    def read_all(self, stream, size):
+        parts = []
+        while True:
+            data = stream.read(size)
+            if not data:
+                return b''.join(parts)
+            parts.append(data)
+
+    def test_read_sizes(self):
+        data = _gzip(self.xml)
+        for size in (1, 1000, 1 << 20):
+            self.assertEqual(self.xml, self.read_all(GzipStream(iter_chunks(data, 100)), size))
+        self.assertEqual(self.xml, GzipStream([data]).read())
+
+    def test_concatenated_members(self):
+        data = _gzip(self.xml) + _gzip(self.xml)
+        self.assertEqual(self.xml + self.xml, self.read_all(GzipStream(iter_chunks(data, 100)), 4096))
+
+    def test_truncated(self):
+        data = _gzip(self.xml)
+        for cut in (1, 4, 8, len(data) // 2):
+            stream = GzipStream(iter_chunks(data[:-cut], 100))
+            self.assertRaises(EOFError, self.read_all, stream, 4096)
+
+    def test_empty(self):
+        self.assertEqual(b'', GzipStream([]).read())
+
+
+class TestTransport(unittest.TestCase):
+    def test_stream_reuses_connections(self):
+        with FakeServer(replication_feed(5)) as server:
+            transport = Transport()
+            finished = []
+            changes = []
+            for action, obj in iter_osm_stream(1, server.url + '/minute', transport=transport):
+                if action is None:
+                    finished.append(int(obj.sequence))
+                    if len(finished) == 4:
+                        break
+                else:
+                    changes.append((action, obj.id))
+            transport.close()
+
+        self.assertEqual([1, 2, 3, 4], finished)
+        self.assertEqual([('modify', 1), ('modify', 2), ('modify', 3), ('modify', 4)], changes)
+
+        # A state file and a diff per sequence, all over one connection
+        self.assertGreaterEqual(len(server.requests), 8)
+        self.assertEqual(1, server.connections)
+
+
+if __name__ == '__main__':
+    unittest.main()